@@ -2,24 +2,237 @@
 
 requirements:
 psutil
+scheduler.py script (from this repository, in the same folder)
 """
 
+import functools
+import io
+import itertools
 import os
+import re
+import sqlite3
 import subprocess
+import sys
+import threading
 import time
-from threading import Thread
-from typing import List, Optional, Set
+import tracemalloc
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from threading import Event, Lock, Thread, get_ident
+from types import FrameType
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 import deltachat
 import psutil
+import scheduler
 import simplebot
 from simplebot.bot import DeltaBot, Replies, get_admins
 
+DURATIONS = {"m": 60, "h": 60 * 60, "d": 60 * 60 * 24, "w": 60 * 60 * 24 * 7}
+SAMPLE_INTERVAL = 60
+SPARKS = "▁▂▃▄▅▆▇█"
+QUOTA_CHECK_INTERVAL = 60 * 60
+BULK_THRESHOLD = 10
+PROGRESS_INTERVAL = 30
+MAX_FINISHED_JOBS = 20
+PROFILE_INTERVAL = 0.01
+ban_store: Optional["BanStore"] = None
+metrics: Optional["MetricsHistory"] = None
+quota_alert = {"quota": 0, "time": 0.0}
+jobs: Dict[int, "BulkJob"] = OrderedDict()
+job_ids = itertools.count(1)
+job_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="admin_jobs")
+profile_lock = Lock()
+
+
+class BanStore:
+    """Banned addresses with optional reason and expiration time.
+
+    Bans are persisted in a SQLite table and kept in memory so checking if an
+    address is banned doesn't touch the database.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS banned (
+                addr TEXT PRIMARY KEY,
+                reason TEXT,
+                expires REAL)"""
+            )
+        self._bans: Dict[str, Tuple[Optional[str], Optional[float]]] = {
+            addr: (reason, expires)
+            for addr, reason, expires in self._db.execute("SELECT * FROM banned")
+        }
+
+    def __contains__(self, addr: str) -> bool:
+        ban = self._bans.get(addr)
+        return ban is not None and (ban[1] is None or ban[1] > time.time())
+
+    def __len__(self) -> int:
+        return len(self._bans)
+
+    def items(self) -> List[Tuple[str, Optional[str], Optional[float]]]:
+        return [(addr, *ban) for addr, ban in list(self._bans.items())]
+
+    def add(self, bans: Iterable[Tuple[str, Optional[str], Optional[float]]]) -> None:
+        """Add (addr, reason, expires) bans in a single transaction."""
+        bans = list(bans)
+        with self._lock, self._db:
+            self._db.executemany("REPLACE INTO banned VALUES (?,?,?)", bans)
+            for addr, reason, expires in bans:
+                self._bans[addr] = (reason, expires)
+
+    def remove(self, addrs: Iterable[str]) -> None:
+        addrs = list(addrs)
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM banned WHERE addr=?", [(addr,) for addr in addrs]
+            )
+            for addr in addrs:
+                self._bans.pop(addr, None)
+
+    def expired(self) -> List[str]:
+        now = time.time()
+        return [
+            addr
+            for addr, (_, expires) in list(self._bans.items())
+            if expires is not None and expires <= now
+        ]
+
+
+class MetricsHistory:
+    """Periodic system samples stored in fixed size ring buffers."""
+
+    fields = (
+        "cpu",
+        "mem",
+        "mem_total",
+        "swap",
+        "swap_total",
+        "disk",
+        "disk_total",
+        "bot_cpu",
+        "bot_mem",
+        "bot_swap",
+    )
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.count = 0
+        self._times = array("d", bytes(8 * size))
+        self._data = {field: array("d", bytes(8 * size)) for field in self.fields}
+        self._lock = Lock()
+
+    def add(self, sample: Dict[str, float]) -> None:
+        with self._lock:
+            index = self.count % self.size
+            self._times[index] = time.time()
+            for field in self.fields:
+                self._data[field][index] = sample[field]
+            self.count += 1
+
+    def last(self) -> Optional[Dict[str, float]]:
+        with self._lock:
+            if not self.count:
+                return None
+            index = (self.count - 1) % self.size
+            return {field: self._data[field][index] for field in self.fields}
+
+    def window(self, field: str, seconds: float) -> List[float]:
+        """Get the samples of the last given seconds, oldest first."""
+        since = time.time() - seconds
+        values = []
+        with self._lock:
+            for i in range(max(self.count - self.size, 0), self.count):
+                index = i % self.size
+                if self._times[index] >= since:
+                    values.append(self._data[field][index])
+        return values
+
+
+class BulkJob:
+    """Background operation applied to many items, reporting progress to a chat.
+
+    Items are processed in batches, waiting ``delay`` seconds after each item
+    to avoid flooding the chats with system messages.
+    """
+
+    def __init__(
+        self,
+        description: str,
+        chat,
+        items: list,
+        action: Callable,
+        delay: float = 0,
+        batch_size: int = 50,
+    ) -> None:
+        self.id = next(job_ids)
+        self.description = description
+        self.chat = chat
+        self.items = items
+        self.action = action
+        self.delay = delay
+        self.batch_size = batch_size
+        self.done = 0
+        self.failed = 0
+        self.status = "queued"
+        self.cancelled = Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("finished", "cancelled", "failed")
+
+    def run(self, logger) -> None:
+        self.status = "running"
+        try:
+            self._run(logger)
+            self.status = "cancelled" if self.cancelled.is_set() else "finished"
+        except Exception as err:
+            logger.exception(err)
+            self.status = "failed"
+        try:
+            icon = "❌" if self.status == "failed" else "✔️"
+            self.chat.send_text(f"{icon} Job #{self.id} {self.status}: {self}")
+        except Exception as err:
+            logger.exception(err)
+
+    def _run(self, logger) -> None:
+        self.chat.send_text(f"⏳ Job #{self.id} started: {self}")
+        last_report = time.time()
+        for i in range(0, len(self.items), self.batch_size):
+            for item in self.items[i : i + self.batch_size]:
+                if self.cancelled.is_set():
+                    return
+                try:
+                    self.action(item)
+                except Exception as err:
+                    logger.exception(err)
+                    self.failed += 1
+                self.done += 1
+                self.cancelled.wait(self.delay)
+            if time.time() - last_report > PROGRESS_INTERVAL:
+                last_report = time.time()
+                try:
+                    self.chat.send_text(f"⏳ Job #{self.id}: {self}")
+                except Exception as err:  # don't stop the job for a report
+                    logger.exception(err)
+
+    def __str__(self) -> str:
+        text = f"{self.description} ({self.done}/{len(self.items)}"
+        if self.failed:
+            text += f", {self.failed} failed"
+        return text + ")"
+
 
 @simplebot.hookimpl(tryfirst=True)
 def deltabot_incoming_message(bot: DeltaBot, message) -> Optional[bool]:
     contact = message.get_sender_contact()
-    if contact.addr in get_banned(bot):
+    if ban_store is not None and contact.addr in ban_store:
         bot.logger.debug("Incoming message from banned contact: %s", contact.addr)
         contact.block()
         bot.plugins._pm.hook.deltabot_ban(bot=bot, contact=contact)
@@ -30,7 +243,7 @@ def deltabot_incoming_message(bot: DeltaBot, message) -> Optional[bool]:
 
 @simplebot.hookimpl
 def deltabot_member_added(bot: DeltaBot, chat, contact) -> None:
-    if contact.addr in get_banned(bot):
+    if ban_store is not None and contact.addr in ban_store:
         bot.logger.debug("Banned contact added: %s", contact.addr)
         chat.remove_contact(contact)
         contact.block()
@@ -40,44 +253,154 @@ def deltabot_member_added(bot: DeltaBot, chat, contact) -> None:
 
 @simplebot.hookimpl
 def deltabot_start(bot: DeltaBot) -> None:
-    Thread(target=check_quota, args=(bot,)).start()
+    global ban_store
+    ban_store = BanStore(os.path.join(os.path.dirname(bot.account.db_path), "admin.db"))
+    legacy = bot.get("banned", scope=__name__)
+    if legacy:
+        ban_store.add((addr, None, None) for addr in legacy.split())
+        bot.set("banned", "", scope=__name__)
+    global metrics
+    metrics = MetricsHistory(60 * 60 * 24 // SAMPLE_INTERVAL)
+    proc = psutil.Process()
+    _sample_metrics(proc)  # the first CPU percent readings are meaningless
+    scheduler.every(SAMPLE_INTERVAL, sample_metrics, proc, name="admin.sample_metrics")
+    scheduler.every(
+        QUOTA_CHECK_INTERVAL, check_quota, bot, name="admin.check_quota", delay=0
+    )
+    scheduler.every(60, check_expired_bans, bot, name="admin.check_expired_bans")
 
 
 @simplebot.command(admin=True)
 def stats(replies: Replies) -> None:
-    """Get bot and computer state."""
-    mem = psutil.virtual_memory()
-    swap = psutil.swap_memory()
-    disk = psutil.disk_usage(os.path.expanduser("~/.simplebot/"))
-    proc = psutil.Process()
-    botmem = proc.memory_full_info()
-    replies.add(
-        text="**🖥️ Computer Stats:**\n"
-        f"CPU: {psutil.cpu_percent(interval=0.1)}%\n"
-        f"Memory: {sizeof_fmt(mem.used)}/{sizeof_fmt(mem.total)}\n"
-        f"Swap: {sizeof_fmt(swap.used)}/{sizeof_fmt(swap.total)}\n"
-        f"Disk: {sizeof_fmt(disk.used)}/{sizeof_fmt(disk.total)}\n\n"
+    """Get bot and computer state, with the history of the last 1h and 24h."""
+    sample = (metrics and metrics.last()) or _sample_metrics(psutil.Process())
+    text = (
+        "**🖥️ Computer Stats:**\n"
+        f"CPU: {sample['cpu']}%\n"
+        f"Memory: {sizeof_fmt(sample['mem'])}/{sizeof_fmt(sample['mem_total'])}\n"
+        f"Swap: {sizeof_fmt(sample['swap'])}/{sizeof_fmt(sample['swap_total'])}\n"
+        f"Disk: {sizeof_fmt(sample['disk'])}/{sizeof_fmt(sample['disk_total'])}\n\n"
         "**🤖 Bot Stats:**\n"
-        f"CPU: {proc.cpu_percent(interval=0.1)}%\n"
-        f"Memory: {sizeof_fmt(botmem.rss)}\n"
-        f"Swap: {sizeof_fmt(botmem.swap if 'swap' in botmem._fields else 0)}\n"
+        f"CPU: {sample['bot_cpu']}%\n"
+        f"Memory: {sizeof_fmt(sample['bot_mem'])}\n"
+        f"Swap: {sizeof_fmt(sample['bot_swap'])}\n"
         f"SimpleBot: {simplebot.__version__}\n"
         f"DeltaChat: {deltachat.__version__}\n"
     )
+    if metrics and metrics.count:
+        for title, seconds in (("1h", 60 * 60), ("24h", 60 * 60 * 24)):
+            text += f"\n**📈 Last {title}** (min/avg/max/p95):\n"
+            for name, field in (
+                ("CPU", "cpu"),
+                ("Memory", "mem"),
+                ("Swap", "swap"),
+                ("Disk", "disk"),
+                ("Bot CPU", "bot_cpu"),
+                ("Bot Memory", "bot_mem"),
+            ):
+                fmt = (lambda val: f"{val:.1f}%") if "cpu" in field else sizeof_fmt
+                text += _summarize(name, metrics.window(field, seconds), fmt)
+    replies.add(text=text)
+
+
+@simplebot.command(admin=True)
+def profile(bot: DeltaBot, args: list, message, replies: Replies) -> None:
+    """Profile the bot for the given seconds and get a report.
+
+    The second argument selects what to profile: cpu, mem or all (default).
+    The CPU profile is also sent as collapsed stacks for flame graph tools.
+    Example:
+    /profile 30 cpu
+    """
+    try:
+        seconds = float(args[0]) if args else 30
+    except ValueError:
+        seconds = 0
+    mode = args[1] if len(args) > 1 else "all"
+    if mode not in ("cpu", "mem", "all") or not 0 < seconds <= 60 * 10:
+        replies.add(text="❌ Invalid arguments", quote=message)
+    elif not profile_lock.acquire(blocking=False):
+        replies.add(text="❌ A profile is already running", quote=message)
+    else:
+        Thread(
+            target=_profile, args=(bot, message.chat, seconds, mode), daemon=True
+        ).start()
+        replies.add(text=f"⏳ Profiling for {seconds:.0f}s...", quote=message)
 
 
 @simplebot.command(admin=True)
 def ban2(bot: DeltaBot, payload: str, message, replies: Replies) -> None:
-    """ban forever."""
-    if payload:
-        banned = add_banned(bot, payload.split())
-    elif message.quote:
-        banned = add_banned(bot, message.quote.get_sender_contact().addr.split())
+    """ban forever, or for the given time, with an optional reason.
+
+    Examples:
+    /ban2 spammer@example.com other@example.org
+    /ban2 7d spammer@example.com
+    Flooding the group
+    """
+    lines = payload.split("\n", maxsplit=1)
+    reason = lines[1].strip() if len(lines) == 2 else None
+    expires = None
+    addrs = []
+    for arg in lines[0].split():
+        if re.fullmatch(r"\d+[mhdw]", arg):
+            expires = time.time() + int(arg[:-1]) * DURATIONS[arg[-1]]
+        else:
+            addrs.append(arg)
+    if not addrs and message.quote:
+        addrs.append(message.quote.get_sender_contact().addr)
+    if addrs:
+        banned = _ban(
+            bot, [(addr, reason, expires) for addr in addrs], _admin_chat(bot, message)
+        )
     else:
         banned = get_banned(bot)
     replies.add(text=f"Banned ({len(banned)})", html="<br>".join(banned))
 
 
+@simplebot.command(name="/banExport", admin=True)
+def ban_export(replies: Replies) -> None:
+    """Get the list of banned addresses as a file."""
+    assert ban_store is not None
+    lines = [
+        f"{addr}\t{expires or ''}\t{reason or ''}"
+        for addr, reason, expires in sorted(ban_store.items())
+    ]
+    replies.add(
+        text=f"Banned ({len(lines)})",
+        filename="banned.tsv",
+        bytefile=io.BytesIO("\n".join(lines).encode()),
+    )
+
+
+@simplebot.command(name="/banImport", admin=True)
+def ban_import(bot: DeltaBot, payload: str, message, replies: Replies) -> None:
+    """Ban the addresses in the attached file (as exported by /banExport) or in the given text."""
+    if message.filename:
+        with open(message.filename, encoding="utf-8") as file:
+            lines = file.read().split("\n")
+    else:
+        lines = payload.split()
+    bans = []
+    invalid = 0
+    for line in lines:
+        addr, expires, reason = (line.split("\t", maxsplit=2) + ["", ""])[:3]
+        addr = addr.strip()
+        if not addr:
+            continue
+        if "@" not in addr:  # like a header line
+            invalid += 1
+            continue
+        try:
+            bans.append((addr, reason or None, float(expires) if expires else None))
+        except ValueError:
+            invalid += 1
+    banned = _ban(bot, bans, _admin_chat(bot, message))
+    text = f"Imported {len(bans)} bans, banned: {len(banned)}"
+    if invalid:
+        text += f"\n❌ Skipped {invalid} invalid lines"
+    replies.add(text=text)
+
+
 @simplebot.command(admin=True)
 def move(bot: DeltaBot, payload: str, message) -> None:
     """move to group."""
@@ -99,10 +422,37 @@ def unban2(bot: DeltaBot, payload: str, replies: Replies) -> None:
 
 @simplebot.command(admin=True)
 def destroy(bot: DeltaBot, message) -> None:
-    """Destroy group."""
-    for c in message.chat.get_contacts():
-        if c != bot.self_contact:
-            message.chat.remove_contact(c)
+    """Destroy group, members are removed in background (see /jobs)."""
+    chat = message.chat
+    sender = message.get_sender_contact()
+    contacts = [c for c in chat.get_contacts() if c not in (bot.self_contact, sender)]
+    delay = float(_getdefault(bot, "bulk_delay", "1"))
+    job = BulkJob(
+        f"destroy group {chat.id}",
+        _admin_chat(bot, message),
+        contacts,
+        chat.remove_contact,
+        delay,
+    )
+    run_job(bot, job)
+
+
+@simplebot.command(name="/jobs", admin=True)
+def jobs_cmd(payload: str, replies: Replies) -> None:
+    """List background jobs, or cancel one with: /jobs cancel ID"""
+    args = payload.split()
+    if len(args) == 2 and args[0] == "cancel" and args[1].isdigit():
+        job = jobs.get(int(args[1]))
+        if not job:
+            replies.add(text="❌ Unknown job")
+        elif job.finished:
+            replies.add(text=f"❌ Job #{job.id} already {job.status}")
+        else:
+            job.cancelled.set()
+            replies.add(text=f"Cancelling job #{job.id}")
+        return
+    lines = [f"#{job.id} [{job.status}] {job}" for job in list(jobs.values())]
+    replies.add(text="\n\n".join(lines) or "❌ No jobs")
 
 
 @simplebot.command(admin=True)
@@ -126,28 +476,172 @@ def verify(bot: DeltaBot, replies: Replies) -> None:
 
 
 def get_banned(bot: DeltaBot) -> Set[str]:
-    return set((bot.get("banned", scope=__name__) or "").split())
+    assert ban_store is not None
+    return {addr for addr, _, _ in ban_store.items() if addr in ban_store}
 
 
 def del_banned(bot: DeltaBot, addrs: List[str]) -> Set[str]:
-    banned = get_banned(bot) - set(addrs)
-    bot.set("banned", " ".join(banned), scope=__name__)
+    assert ban_store is not None
+    ban_store.remove(addrs)
     for addr in addrs:
         contact = bot.get_contact(addr)
         contact.unblock()
         bot.plugins._pm.hook.deltabot_unban(bot=bot, contact=contact)
-    return banned
+    return get_banned(bot)
+
+
+def add_banned(
+    bot: DeltaBot,
+    addrs: List[str],
+    reason: Optional[str] = None,
+    expires: Optional[float] = None,
+) -> Set[str]:
+    return _ban(bot, [(addr, reason, expires) for addr in addrs])
+
+
+def _ban(
+    bot: DeltaBot,
+    bans: List[Tuple[str, Optional[str], Optional[float]]],
+    chat=None,
+) -> Set[str]:
+    """Ban the given addresses, blocking them in background if they are many."""
+    assert ban_store is not None
+    ban_store.add(bans)
+    addrs = [addr for addr, _, _ in bans]
+    block = functools.partial(_block, bot)
+    if chat and len(addrs) > BULK_THRESHOLD:
+        run_job(bot, BulkJob(f"ban {len(addrs)} addresses", chat, addrs, block))
+    else:
+        for addr in addrs:
+            block(addr)
+    return get_banned(bot)
 
 
-def add_banned(bot: DeltaBot, addrs: List[str]) -> Set[str]:
-    banned = get_banned(bot).union(set(addrs))
-    bot.set("banned", " ".join(banned), scope=__name__)
-    for addr in addrs:
-        contact = bot.get_contact(addr)
-        contact.block()
-        bot.plugins._pm.hook.deltabot_ban(bot=bot, contact=contact)
-        contact.block()
-    return banned
+def _admin_chat(bot: DeltaBot, message):
+    """Get the 1:1 chat with the admin that sent the command, for job reports."""
+    return bot.get_chat(message.get_sender_contact())
+
+
+def _block(bot: DeltaBot, addr: str) -> None:
+    contact = bot.get_contact(addr)
+    contact.block()
+    bot.plugins._pm.hook.deltabot_ban(bot=bot, contact=contact)
+    contact.block()
+
+
+def run_job(bot: DeltaBot, job: BulkJob) -> None:
+    jobs[job.id] = job
+    finished = [j for j in jobs.values() if j.finished]
+    for old_job in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+        del jobs[old_job.id]
+    job_pool.submit(job.run, bot.logger)
+
+
+def _profile(bot: DeltaBot, chat, seconds: float, mode: str) -> None:
+    try:
+        proc = psutil.Process()
+        cpu_times, rss = proc.cpu_times(), proc.memory_info().rss
+        started_tracemalloc = False
+        if mode in ("mem", "all") and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            started_tracemalloc = True
+        stacks: Counter = Counter()
+        if mode in ("cpu", "all"):
+            samples = _sample_stacks(seconds, stacks)
+        else:
+            time.sleep(seconds)
+            samples = 0
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        if started_tracemalloc:
+            tracemalloc.stop()
+        cpu_times2 = proc.cpu_times()
+        cpu = cpu_times2.user + cpu_times2.system - cpu_times.user - cpu_times.system
+        report = [
+            f"Profiled {seconds:.0f}s, bot CPU time: {cpu:.2f}s,"
+            f" memory: {sizeof_fmt(rss)} -> {sizeof_fmt(proc.memory_info().rss)}"
+        ]
+        if stacks:
+            report.append(_stacks_report(stacks, samples))
+        if snapshot:
+            report.append("\n**Top allocation sites:**")
+            for stat in snapshot.statistics("lineno")[:25]:
+                report.append(str(stat))
+        # outside the blobdir, Delta Chat copies the files when they are sent
+        with TemporaryDirectory() as tempdir:
+            prefix = os.path.join(tempdir, f"profile-{int(time.time())}")
+            with open(f"{prefix}.txt", "w", encoding="utf-8") as file:
+                file.write("\n".join(report))
+            replies = Replies(bot, bot.logger)
+            replies.add(text="📊 Profile report", filename=f"{prefix}.txt", chat=chat)
+            if stacks:
+                with open(f"{prefix}.collapsed", "w", encoding="utf-8") as file:
+                    for stack, count in stacks.items():
+                        file.write(f"{stack} {count}\n")
+                replies.add(filename=f"{prefix}.collapsed", chat=chat)
+            replies.send_reply_messages()
+    except Exception as err:
+        bot.logger.exception(err)
+        chat.send_text(f"❌ Profiling failed: {err}")
+    finally:
+        profile_lock.release()
+
+
+def _sample_stacks(seconds: float, stacks: Counter) -> int:
+    """Sample the stacks of the threads that are using the CPU.
+
+    Each stack is weighted by the CPU time its thread used since the previous
+    sample, in milliseconds, so idle threads are not counted.
+    Returns the number of sampling rounds.
+    """
+    proc = psutil.Process()
+    own_id = get_ident()
+    last_cpu: Dict[int, float] = {}
+    samples = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        native_ids = {
+            thread.ident: thread.native_id for thread in threading.enumerate()
+        }
+        cpu = {t.id: t.user_time + t.system_time for t in proc.threads()}
+        for thread_id, frame in sys._current_frames().items():
+            native_id = native_ids.get(thread_id)
+            if thread_id == own_id or native_id is None or native_id not in cpu:
+                continue
+            used = cpu[native_id] - last_cpu.get(native_id, cpu[native_id])
+            last_cpu[native_id] = cpu[native_id]
+            if used <= 0:
+                continue
+            names = []
+            current: Optional[FrameType] = frame
+            while current is not None:
+                code = current.f_code
+                names.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                current = current.f_back
+            stacks[";".join(reversed(names))] += round(used * 1000)
+        samples += 1
+        time.sleep(PROFILE_INTERVAL)
+    return samples
+
+
+def _stacks_report(stacks: Counter, samples: int) -> str:
+    total = sum(stacks.values())
+    cumulative: Counter = Counter()
+    own: Counter = Counter()
+    for stack, count in stacks.items():
+        names = stack.split(";")
+        own[names[-1]] += count
+        for name in set(names):
+            cumulative[name] += count
+    lines = [
+        f"\n**Top functions by CPU time** ({total}ms sampled in {samples} rounds):"
+    ]
+    for name, count in cumulative.most_common(25):
+        lines.append(
+            f"{count / total:6.1%} cumulative {own[name] / total:6.1%} own  {name}"
+        )
+    return "\n".join(lines)
 
 
 def sizeof_fmt(num: float) -> str:
@@ -159,15 +653,80 @@ def sizeof_fmt(num: float) -> str:
     return "%.1f%s%s" % (num, "Yi", suffix)  # noqa
 
 
+def _sample_metrics(proc: psutil.Process) -> Dict[str, float]:
+    mem = psutil.virtual_memory()
+    swap = psutil.swap_memory()
+    disk = psutil.disk_usage(os.path.expanduser("~/.simplebot/"))
+    botmem = proc.memory_full_info()
+    return dict(
+        cpu=psutil.cpu_percent(interval=None),
+        mem=mem.used,
+        mem_total=mem.total,
+        swap=swap.used,
+        swap_total=swap.total,
+        disk=disk.used,
+        disk_total=disk.total,
+        bot_cpu=proc.cpu_percent(interval=None),
+        bot_mem=botmem.rss,
+        bot_swap=botmem.swap if "swap" in botmem._fields else 0,
+    )
+
+
+def _summarize(name: str, values: List[float], fmt) -> str:
+    if not values:
+        return ""
+    ordered = sorted(values)
+    p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+    stats_text = "/".join(
+        fmt(val) for val in (ordered[0], sum(values) / len(values), ordered[-1], p95)
+    )
+    return f"{name}: {stats_text}\n{_sparkline(values)}\n"
+
+
+def _sparkline(values: List[float], width: int = 24) -> str:
+    step = max(len(values) / width, 1)
+    buckets = []
+    index = 0.0
+    while int(index) < len(values):
+        chunk = values[int(index) : int(index + step)]
+        buckets.append(sum(chunk) / len(chunk))
+        index += step
+    low, high = min(buckets), max(buckets)
+    scale = (len(SPARKS) - 1) / (high - low) if high > low else 0
+    return "".join(SPARKS[int((val - low) * scale)] for val in buckets)
+
+
+def sample_metrics(proc: psutil.Process) -> None:
+    assert metrics is not None
+    metrics.add(_sample_metrics(proc))
+
+
+def _getdefault(bot: DeltaBot, key: str, value: str = None) -> str:
+    val = bot.get(key, scope=__name__)
+    if val is None and value is not None:
+        bot.set(key, value, scope=__name__)
+        val = value
+    return val
+
+
 def check_quota(bot: DeltaBot) -> None:
-    while True:
-        try:
-            quota = int(bot.account.get_config("quota_exceeding") or 0)
-            if quota >= 80:
-                for admin in get_admins(bot):
-                    bot.get_chat(admin).send_text(
-                        f"Bot's inbox is almost full: {quota}%"
-                    )
-        except KeyError as err:
-            bot.logger.exception(err)
-        time.sleep(60 * 60 * 24)
+    try:
+        quota = int(bot.account.get_config("quota_exceeding") or 0)
+    except KeyError as err:
+        bot.logger.exception(err)
+        return
+    # alert again only if the quota grew or once per day
+    if quota >= 80 and (
+        quota > quota_alert["quota"] or time.time() - quota_alert["time"] > 60 * 60 * 24
+    ):
+        quota_alert.update(quota=quota, time=time.time())
+        for admin in get_admins(bot):
+            bot.get_chat(admin).send_text(f"Bot's inbox is almost full: {quota}%")
+
+
+def check_expired_bans(bot: DeltaBot) -> None:
+    assert ban_store is not None
+    expired = ban_store.expired()
+    if expired:
+        bot.logger.debug("Removing %s expired bans", len(expired))
+        del_banned(bot, expired)
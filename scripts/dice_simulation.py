@@ -0,0 +1,270 @@
+"""Monte-Carlo simulation and benchmark of the dice_tournament.py games.
+
+This is not a plugin, it plays tavern games and tournaments with the code of
+dice_tournament.py against an in-memory SQLite stand-in for simplebot_score
+and reports the throughput and how the score ended up distributed. Run it
+from this folder:
+
+  python3 dice_simulation.py --users 1000 --games 100000
+  python3 dice_simulation.py --bet 10 --cooldown 300 --bracket 20
+  python3 dice_simulation.py --batch 50 --db sqlite:///simulation.db
+  python3 dice_simulation.py --fast --users 100000 --games 10000000
+
+The --fast mode skips the database and pairs players without the tavern's
+waiting time, so it only measures the economics of the dice. --batch plays
+that many /taberna calls per transaction, like the group commit does with
+concurrent calls.
+
+requirements:
+sqlalchemy
+simplebot (imported by dice_tournament.py)
+dice_tournament.py and scheduler.py scripts (from this repository, in the same folder)
+
+optional requirements:
+numpy (needed for --fast)
+"""
+
+import argparse
+import heapq
+import random
+import sys
+import time
+import types
+from contextlib import contextmanager
+from typing import Any, List, Tuple
+
+from sqlalchemy import Column, Integer, String, create_engine, event, func
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore
+
+db_ops = [0]
+
+
+def _install_score_stub(url: str) -> types.ModuleType:
+    """Register a minimal simplebot_score module backed by the given database."""
+    engine = create_engine(
+        url, poolclass=StaticPool, connect_args={"check_same_thread": False}
+    )
+    event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda *args: db_ops.__setitem__(0, db_ops[0] + 1),
+    )
+    session_factory = sessionmaker(bind=engine)
+
+    class _Base:
+        @declared_attr
+        def __tablename__(cls):  # noqa
+            return cls.__name__.lower()
+
+    Base: Any = declarative_base(cls=_Base)
+
+    class User(Base):
+        addr = Column(String(500), primary_key=True)
+        score = Column(Integer, nullable=False, default=0)
+
+    @contextmanager
+    def session_scope():
+        session = session_factory()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    orm = types.ModuleType("simplebot_score.orm")
+    orm.Base = Base  # type: ignore
+    orm.User = User  # type: ignore
+    orm.session_scope = session_scope  # type: ignore
+    orm.engine = engine  # type: ignore
+    score = types.ModuleType("simplebot_score")
+    score._getdefault = lambda bot, key, value=None: value  # type: ignore
+    score.orm = orm  # type: ignore
+    sys.modules["simplebot_score"] = score
+    sys.modules["simplebot_score.orm"] = orm
+    return orm
+
+
+def simulate(args: argparse.Namespace) -> Tuple[List[int], dict]:
+    """Play the games with the dice_tournament.py code and a SQLite database."""
+    orm = _install_score_stub(args.db)
+    import dice_tournament as dice
+
+    dice.BET = args.bet
+    dice.TAVERN_COOLDOWN = args.cooldown
+    dice.SCORE_BRACKET = args.bracket
+    User, session_scope = orm.User, orm.session_scope
+    orm.Base.metadata.create_all(orm.engine)
+
+    addrs = [f"user{i}@example.org" for i in range(args.users)]
+    with session_scope() as session:
+        session.bulk_insert_mappings(User, [dict(addr=addr, score=0) for addr in addrs])
+        dice._write_ledger(
+            session, [dice._ledger_row(addr, args.score, "opening") for addr in addrs]
+        )
+    stats = dict(games=0, joins=0, waiting=0, expired=0, broke=0, tournaments=0)
+    heap: List[Tuple[float, str]] = []
+    now = 0.0
+    played = 0
+    while played < args.games:
+        # concurrent calls share the transaction like with the group commit
+        calls = []
+        for _ in range(min(args.batch, args.games - played)):
+            now += random.expovariate(args.rate / 60)
+            calls.append((random.choice(addrs), now))
+        due = []
+        while heap and heap[0][0] <= calls[0][1]:
+            due.append(heapq.heappop(heap)[1])
+        if due:
+            stats["expired"] += len(dice._expire_players(due, calls[0][1]))
+
+        with dice.matchmaking_lock:
+            results = dice._play_games(calls)
+        for (addr, time_), (result, _) in zip(calls, results):
+            if result == "joined":
+                heapq.heappush(heap, (time_ + dice.TAVERN_COOLDOWN, addr))
+            stats[{"played": "games", "joined": "joins"}.get(result, result)] += 1
+
+        every = args.tournament_every
+        if every and (played + len(calls)) // every > played // every:
+            with dice.matchmaking_lock, session_scope() as session:
+                dice._play_tournament(
+                    session, [User.score >= args.tournament_bet], args.tournament_bet
+                )
+            stats["tournaments"] += 1
+        played += len(calls)
+
+    # refund the players still waiting in the tavern
+    if heap:
+        stats["expired"] += len(
+            dice._expire_players([addr for _, addr in heap], float("inf"))
+        )
+    with session_scope() as session:
+        scores = [score for (score,) in session.query(User.score)]
+        stats["ledger"] = session.query(func.sum(dice.ScoreLedger.delta)).scalar()
+    stats["db_ops"] = db_ops[0]
+    return scores, stats
+
+
+def simulate_fast(args: argparse.Namespace) -> Tuple[List[int], dict]:
+    """Play the games with NumPy, pairing all the players that can pay at once."""
+    rng = np.random.default_rng(args.seed)
+    scores = np.full(args.users, args.score, dtype=np.int64)
+    stats = dict(games=0, tournaments=0)
+    next_tournament = args.tournament_every or float("inf")
+    while stats["games"] < args.games:
+        eligible = np.flatnonzero(scores >= args.bet)
+        count = min(len(eligible) // 2, args.games - stats["games"])
+        if args.tournament_every:
+            count = min(count, next_tournament - stats["games"])
+        if len(eligible) < 2:
+            break
+        players = rng.permutation(eligible)[: count * 2].reshape(-1, 2)
+        rolls = rng.integers(1, 7, size=(count, 2, 2)).sum(axis=2)
+        tied = np.flatnonzero(rolls[:, 0] == rolls[:, 1])
+        while len(tied):
+            rolls[tied] = rng.integers(1, 7, size=(len(tied), 2, 2)).sum(axis=2)
+            tied = tied[rolls[tied, 0] == rolls[tied, 1]]
+        first_won = rolls[:, 0] > rolls[:, 1]
+        winners = np.where(first_won, players[:, 0], players[:, 1])
+        losers = np.where(first_won, players[:, 1], players[:, 0])
+        scores[winners] += args.bet
+        scores[losers] -= args.bet
+        stats["games"] += count
+
+        if stats["games"] >= next_tournament:
+            next_tournament += args.tournament_every
+            participants = np.flatnonzero(scores >= args.tournament_bet)
+            if len(participants):
+                rolls = rng.integers(1, 7, size=(len(participants), 5)).sum(axis=1)
+                best = np.flatnonzero(rolls == rolls.max())
+                scores[participants] -= args.tournament_bet
+                scores[participants[rng.choice(best)]] += args.tournament_bet * len(
+                    participants
+                )
+            stats["tournaments"] += 1
+    return scores.tolist(), stats
+
+
+def _summary(scores: List[int], bet: int) -> List[str]:
+    scores = sorted(scores)
+    count = len(scores)
+    total = sum(scores)
+    # Gini coefficient of the sorted scores
+    weighted = sum(i * score for i, score in enumerate(scores, 1))
+    gini = (2 * weighted / (count * total) - (count + 1) / count) if total else 0
+    top = scores[-max(count // 100, 1) :]
+    return [
+        f"Total score: {total}",
+        f"Mean: {total / count:.1f}  Median: {scores[count // 2]}"
+        f"  Min: {scores[0]}  Max: {scores[-1]}",
+        f"Gini: {gini:.3f}",
+        f"Top 1% holds: {sum(top) / total * 100 if total else 0:.1f}%",
+        f"Can't pay the bet: {sum(s < bet for s in scores) / count * 100:.1f}%",
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--games", type=int, default=10000, help="/taberna calls")
+    parser.add_argument("--score", type=int, default=50, help="initial score")
+    parser.add_argument("--bet", type=int, default=5)
+    parser.add_argument("--cooldown", type=float, default=60 * 15)
+    parser.add_argument("--bracket", type=int, default=0)
+    parser.add_argument(
+        "--rate", type=float, default=30, help="/taberna calls per minute"
+    )
+    parser.add_argument(
+        "--tournament-every", type=int, default=0, help="/taberna calls, 0 disables"
+    )
+    parser.add_argument("--tournament-bet", type=int, default=1)
+    parser.add_argument(
+        "--batch", type=int, default=1, help="/taberna calls per transaction"
+    )
+    parser.add_argument("--db", default="sqlite://", help="SQLAlchemy database URL")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--fast", action="store_true", help="use NumPy, no database")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.fast and np is None:
+        parser.error("--fast requires numpy")
+    if np is not None:
+        np.random.seed(args.seed)
+    initial = args.users * args.score
+
+    start = time.perf_counter()
+    scores, stats = simulate_fast(args) if args.fast else simulate(args)
+    took = time.perf_counter() - start
+
+    print(f"Simulated {args.games} /taberna calls of {args.users} users in {took:.2f}s")
+    print(f"Games/s: {stats['games'] / took:.0f}")
+    if "db_ops" in stats:
+        print(f"DB statements: {stats['db_ops']} ({stats['db_ops'] / took:.0f}/s)")
+    print(
+        ", ".join(
+            f"{key}: {val}"
+            for key, val in stats.items()
+            if key not in ("db_ops", "ledger")
+        )
+    )
+    print(f"Initial score: {initial}")
+    print("\n".join(_summary(scores, args.bet)))
+    if sum(scores) != initial:
+        sys.exit("❌ The total score changed!")
+    if stats.get("ledger", initial) != initial:
+        sys.exit("❌ The ledger doesn't match the score!")
+
+
+if __name__ == "__main__":
+    main()
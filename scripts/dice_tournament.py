@@ -1,14 +1,33 @@
+"""
+requirements:
+simplebot_score
+scheduler.py script (from this repository, in the same folder)
+
+optional requirements:
+numpy (faster tournaments)
+"""
+
+import heapq
 import random
 import time
-from threading import Thread
-from typing import Optional
+from collections import deque
+from concurrent.futures import Future
+from threading import Lock
+from typing import Deque, Dict, List, Optional, Tuple
 
+import scheduler
 import simplebot
 from deltachat import Message
 from simplebot.bot import DeltaBot, Replies
 from simplebot_score import _getdefault  # noqa
 from simplebot_score.orm import Base, User, session_scope  # noqa
-from sqlalchemy import Column, Float, String
+from sqlalchemy import Column, Float, Integer, String, bindparam, func, literal
+from sqlalchemy import text as sql_text
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore
 
 DICES = {
     1: "⚀",
@@ -20,11 +39,69 @@ DICES = {
 }
 TAVERN_COOLDOWN = 60 * 15
 BET = 5
+SCORE_BRACKET = 0  # prefer opponents within this score distance, 0 to disable
+tavern_heap: List[Tuple[float, str]] = []
+tavern_lock = Lock()
+matchmaking_lock = Lock()  # serializes the games' tavern and score changes
+tavern_check: dict = {"job": None, "deadline": 0.0}
+TOURNAMENT_CHUNK = 1000
+OUTBOX_INTERVAL = 2
+OUTBOX_BATCH = 10  # messages sent every OUTBOX_INTERVAL seconds
+outbox: Deque[Tuple[str, str]] = deque()
+outbox_lock = Lock()
+outbox_job: dict = {"job": None}
+LEDGER_BATCH = 500  # most /taberna calls written in one transaction
 
 
 class Tavern(Base):
     addr = Column(String(500), primary_key=True)
-    join_time = Column(Float, nullable=False)
+    join_time = Column(Float, nullable=False, index=True)
+
+
+class ScoreLedger(Base):
+    id = Column(Integer, primary_key=True)
+    addr = Column(String(500), nullable=False, index=True)
+    delta = Column(Integer, nullable=False)
+    reason = Column(String(100), nullable=False)
+    time = Column(Float, nullable=False)
+
+
+class GroupCommit:
+    """Group commit of the /taberna calls.
+
+    Calls that arrive while a transaction is being written wait in a queue
+    and are then played together by one of them, in a single transaction
+    with all their tavern and score changes. Many games share the same
+    commit and a crash can't leave a game half written.
+    """
+
+    def __init__(self) -> None:
+        self._queue: List[Tuple[str, float, Future]] = []
+        self._lock = Lock()
+
+    def play(self, addr: str, now: float) -> Tuple[str, dict]:
+        """Play a /taberna call, returns like _play_tavern() once committed."""
+        future: Future = Future()
+        with self._lock:
+            self._queue.append((addr, now, future))
+        with matchmaking_lock:
+            # the call may have been played already by an earlier one
+            while not future.done():
+                with self._lock:
+                    batch = self._queue[:LEDGER_BATCH]
+                    del self._queue[:LEDGER_BATCH]
+                try:
+                    results = _play_games([(addr, now) for addr, now, _ in batch])
+                except Exception as ex:
+                    for _, _, waiter in batch:
+                        waiter.set_exception(ex)
+                else:
+                    for (_, _, waiter), result in zip(batch, results):
+                        waiter.set_result(result)
+        return future.result()
+
+
+tavern_games = GroupCommit()
 
 
 @simplebot.hookimpl
@@ -35,9 +112,47 @@ def deltabot_init(bot: DeltaBot) -> None:
     bot.commands.register(func=taberna, help=desc)
 
 
-@simplebot.hookimpl
+@simplebot.hookimpl(trylast=True)
 def deltabot_start(bot: DeltaBot) -> None:
-    Thread(target=_check_tavern, args=(bot,)).start()
+    # the database is set up by simplebot_score's own start hook, so wait for it
+    scheduler.at(time.time(), _init_db, bot, name="dice.init_db")
+
+
+def _init_db(bot: DeltaBot) -> None:
+    try:
+        _load_tavern()
+    except Exception as err:
+        bot.logger.exception(err)
+        scheduler.at(time.time() + 60, _init_db, bot, name="dice.init_db")
+        return
+    _schedule_tavern_check(bot)
+
+
+def _load_tavern() -> None:
+    table = Tavern.__table__.name
+    with session_scope() as session:
+        # the index is not created by create_all() for already existing tables
+        session.execute(
+            sql_text(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_join_time ON {table} (join_time)"
+            )
+        )
+        players = session.query(Tavern.addr, Tavern.join_time).all()
+        # opening balance of the users that are not in the ledger yet
+        known = session.query(ScoreLedger.addr)
+        opening = session.query(
+            User.addr, User.score, literal("opening"), literal(time.time())
+        ).filter(User.score != 0, User.addr.notin_(known))
+        session.execute(
+            ScoreLedger.__table__.insert().from_select(
+                ["addr", "delta", "reason", "time"], opening.statement
+            )
+        )
+    with tavern_lock:
+        tavern_heap[:] = [
+            (join_time + TAVERN_COOLDOWN, addr) for addr, join_time in players
+        ]
+        heapq.heapify(tavern_heap)
 
 
 @simplebot.command(name="/diceTournament", admin=True)
@@ -46,147 +161,434 @@ def dice_tournament_cmd(bot: DeltaBot, args: list, replies: Replies) -> None:
     badge = _getdefault(bot, "score_badge", "🎖️")
     minimum_score = int(args.pop(0) if args else 1)
     maximum_score = int(args.pop(0) if args else -1)
-    winner = None
-    winner_addr = None
-    winner_roll = 0
-    price = 0
-    addrs = []
-    with session_scope() as session:
-        if maximum_score > minimum_score:
-            query = session.query(User).filter(
-                User.score >= minimum_score, User.score <= maximum_score
-            )
-        elif maximum_score == minimum_score:
-            query = session.query(User).filter(User.score == minimum_score)
+    if maximum_score > minimum_score:
+        cond = [User.score >= minimum_score, User.score <= maximum_score]
+    elif maximum_score == minimum_score:
+        cond = [User.score == minimum_score]
+    else:
+        cond = [User.score >= minimum_score]
+    with matchmaking_lock, session_scope() as session:
+        addrs, winner_addr = _play_tournament(session, cond, minimum_score)
+    if not winner_addr:
+        replies.add(text="❌ No hay usuarios suficientes para realizar un torneo")
+        return
+    price = minimum_score * len(addrs)
+    selected = f"🏆 Fuiste seleccionad@ para participar en un torneo de azar para usuarios con {badge}\n\n"
+    messages = []
+    for addr in addrs:
+        if addr == winner_addr:
+            text = f"🥇 Ganaste el torneo!!! 🎉 Recibes +{price - minimum_score}{badge}"
         else:
-            query = session.query(User).filter(User.score >= minimum_score)
-        for user in query.order_by(User.score).limit(100):
-            user.score -= minimum_score
-            price += minimum_score
-            bot.get_chat(user.addr).send_text(
-                f"🏆 Fuiste seleccionad@ para participar en un torneo de azar para usuarios con {badge}"
+            text = f"💀 Perdiste el torneo, se te descontó -{minimum_score}{badge}"
+        messages.append((addr, selected + text))
+    _send_later(bot, messages)
+    replies.add(
+        f"🏆 El torneo terminó:\n\nGanador: {winner_addr}\nParticipantes: {len(addrs)}"
+    )
+
+
+@simplebot.command(name="/scoreLedger", admin=True)
+def score_ledger_cmd(bot: DeltaBot, args: list, replies: Replies) -> None:
+    """Check the users' score against the ledger of the dice games.
+
+    Send "/scoreLedger adjust" to add the differences to the ledger as
+    adjustments, keeping the current scores. "/scoreLedger rebuild confirm"
+    sets the users' score to their balance in the ledger instead, WARNING:
+    that reverts any score given or taken outside the dice games.
+    """
+    action = args[0] if args else ""
+    if action not in ("", "rebuild", "adjust"):
+        replies.add(text=f"❌ Unknown action: {action}")
+        return
+    confirmed = args[1:2] == ["confirm"]
+    if action == "rebuild" and not confirmed:
+        # only report what would be reverted
+        action = ""
+    with matchmaking_lock, session_scope() as session:
+        balances = dict(
+            session.query(ScoreLedger.addr, func.sum(ScoreLedger.delta)).group_by(
+                ScoreLedger.addr
             )
-            addrs.append(user.addr)
-            roll = sum(_roll_dice(5))
-            if roll == winner_roll:
-                roll2 = winner_roll
-                while roll == roll2:
-                    roll = sum(_roll_dice(5))
-                    roll2 = sum(_roll_dice(5))
-                if roll > roll2:
-                    winner = user
-            elif roll > winner_roll:
-                winner_roll = roll
-                winner = user
-        if winner:
-            winner.score += price
-            winner_addr = winner.addr
-        else:
-            replies.add(text="❌ No hay usuarios suficientes para realizar un torneo")
-    if winner_addr:
-        time.sleep(10)
-        for addr in addrs:
-            if addr == winner_addr:
-                text = (
-                    f"🥇 Ganaste el torneo!!! 🎉 Recibes +{price - minimum_score}{badge}"
-                )
-            else:
-                text = f"💀 Perdiste el torneo, se te descontó -{minimum_score}{badge}"
-            replies.add(text=text, chat=bot.get_chat(addr))
-        replies.add(
-            f"🏆 El torneo terminó:\n\nGanador: {winner_addr}\nParticipantes: {len(addrs)}"
         )
+        entries = session.query(ScoreLedger).count()
+        drift = [
+            (addr, score, balances.get(addr, 0))
+            for addr, score in session.query(User.addr, User.score)
+            if score != balances.get(addr, 0)
+        ]
+        # users that never played are not reset to zero
+        params = [
+            dict(_addr=addr, _score=balance)
+            for addr, _, balance in drift
+            if addr in balances
+        ]
+        if params and action == "rebuild":
+            table = User.__table__
+            session.execute(
+                table.update()
+                .where(table.c.addr == bindparam("_addr"))
+                .values(score=bindparam("_score")),
+                params,
+            )
+        elif drift and action == "adjust":
+            session.bulk_insert_mappings(
+                ScoreLedger,
+                [
+                    _ledger_row(addr, score - balance, "adjustment")
+                    for addr, score, balance in drift
+                ],
+            )
+    text = f"Ledger entries: {entries}\nUsers out of balance: {len(drift)}"
+    if action:
+        text += f"\n\n✔️ Fixed with: {action}"
+    elif drift:
+        text += "\n\n" + "\n".join(
+            f"{addr}: {score} (ledger: {balance})"
+            for addr, score, balance in drift[:20]
+        )
+        if args[:1] == ["rebuild"]:
+            text += (
+                "\n\n⚠️ Rebuilding reverts these scores to the ledger, including"
+                " changes done outside the dice games. Send"
+                ' "/scoreLedger rebuild confirm" to do it or'
+                ' "/scoreLedger adjust" to keep the scores.'
+            )
+    replies.add(text=text)
 
 
 def taberna(bot: DeltaBot, message: Message, replies: Replies) -> None:
     badge = _getdefault(bot, "score_badge", "🎖️")
+    addr = message.get_sender_contact().addr
+    join_time = time.time()
+    result, game = tavern_games.play(addr, join_time)
+    if result == "broke":
+        replies.add(
+            text=f"❌ Debes tener al menos {BET}{badge} para entrar a la taberna",
+            quote=message,
+        )
+        return
+    chat = bot.get_chat(addr)
+    if result == "waiting":
+        replies.add(text="❌ Ya estás en la taberna", chat=chat)
+    elif result == "played":
+        user1, user2 = game["winner"], game["loser"]
+        roll1, roll2 = game["rolls"][user1], game["rolls"][user2]
+        scores = game["scores"]
+        text = "🎲 Lanzan los dados sobre la mesa:\n\n"
+        text += "{0} {1} ({2})\n{3} {4} ({5})\n\n"
+        text += "{0} ganó! y se lleva {6}{7}"
+        text = text.format(
+            bot.get_contact(user1).name,
+            " + ".join(DICES[val] for val in roll1),
+            sum(roll1),
+            bot.get_contact(user2).name,
+            " + ".join(DICES[val] for val in roll2),
+            sum(roll2),
+            BET * 2,
+            badge,
+        )
+        text += "\n\nTienes: "
+        replies.add(text=f"{text}{scores[user1]}{badge}", chat=bot.get_chat(user1))
+        replies.add(text=f"{text}{scores[user2]}{badge}", chat=bot.get_chat(user2))
+    else:  # joined
+        with tavern_lock:
+            heapq.heappush(tavern_heap, (join_time + TAVERN_COOLDOWN, addr))
+        _schedule_tavern_check(bot)
+        replies.add(
+            text=f"🍺 Entras a la taberna, tomas asiento y saboreas tu bebida mientras esperas en los próximos {TAVERN_COOLDOWN // 60} minutos a que algún oponente aparezca para jugar dados",
+            chat=chat,
+        )
+
+
+def _play_games(calls: List[Tuple[str, float]]) -> List[Tuple[str, dict]]:
+    """Play the given (addr, time) /taberna calls in a single transaction.
+
+    Must be called holding matchmaking_lock, so two players can't claim the
+    same opponent. Returns the result of every call, see _play_tavern().
+    """
+    results = []
+    rows: List[dict] = []
+    pending: Dict[str, int] = {}  # score changes not written yet
     with session_scope() as session:
-        user2 = (
-            session.query(User)
-            .filter_by(addr=message.get_sender_contact().addr)
-            .first()
+        for addr, now in calls:
+            result, game, changes = _play_tavern(session, addr, now, pending)
+            for row in changes:
+                pending[row["addr"]] = pending.get(row["addr"], 0) + row["delta"]
+            rows.extend(changes)
+            results.append((result, game))
+        # in the same transaction as the tavern changes
+        _write_ledger(session, rows)
+    return results
+
+
+def _play_tavern(
+    session, addr: str, now: float, pending: Dict[str, int]
+) -> Tuple[str, dict, List[dict]]:
+    """Play a /taberna call of addr at the given time.
+
+    Returns the result, "broke", "waiting", "joined" or "played", for played
+    games a dict with the winner, loser, their rolls and new scores, and the
+    ledger rows to write. The tavern changes are done in the given session,
+    pending are the score changes of the batch not written yet.
+    """
+    score = _get_score(session, addr) + pending.get(addr, 0)
+    if score < BET:
+        return "broke", {}, []
+    match = _get_opponent(addr, session, score)
+    if match:
+        opponent, opponent_score = match
+        scores = {
+            addr: score - BET,
+            opponent: opponent_score + pending.get(opponent, 0),
+        }
+        roll1, roll2 = _tavern_rolls()
+        winner, loser = opponent, addr
+        if sum(roll1) < sum(roll2):
+            winner, loser = loser, winner
+            roll1, roll2 = roll2, roll1
+        scores[winner] += BET * 2
+        changes = [
+            _ledger_row(addr, -BET, "tavern"),
+            _ledger_row(winner, BET * 2, "tavern win"),
+        ]
+        result = "played"
+        game = dict(
+            winner=winner,
+            loser=loser,
+            rolls={winner: roll1, loser: roll2},
+            scores=scores,
         )
-        score = user2.score if user2 else 0
-        if score < BET:
-            replies.add(
-                text=f"❌ Debes tener al menos {BET}{badge} para entrar a la taberna",
-                quote=message,
-            )
-            return
-        user1 = _get_opponent(user2.addr, session)
-        if user1:
-            user2.score -= BET
-            roll1 = _roll_dice()
-            roll2 = _roll_dice()
-            while sum(roll1) == sum(roll2):
-                roll1 = _roll_dice()
-                roll2 = _roll_dice()
-            if sum(roll1) < sum(roll2):
-                user1, user2 = user2, user1
-                roll1, roll2 = roll2, roll1
-
-            user1.score += BET * 2
-
-            text = "🎲 Lanzan los dados sobre la mesa:\n\n"
-            text += "{0} {1} ({2})\n{3} {4} ({5})\n\n"
-            text += "{0} ganó! y se lleva {6}{7}"
-            text = text.format(
-                bot.get_contact(user1.addr).name,
-                " + ".join(DICES[val] for val in roll1),
-                sum(roll1),
-                bot.get_contact(user2.addr).name,
-                " + ".join(DICES[val] for val in roll2),
-                sum(roll2),
-                BET * 2,
-                badge,
-            )
-            text += "\n\nTienes: "
-            replies.add(
-                text=f"{text}{user1.score}{badge}", chat=bot.get_chat(user1.addr)
-            )
-            replies.add(
-                text=f"{text}{user2.score}{badge}", chat=bot.get_chat(user2.addr)
+    elif session.query(Tavern.addr).filter_by(addr=addr).first():
+        return "waiting", {}, []
+    else:
+        # not added to the session, the player could be matched and join
+        # again in the same transaction
+        session.execute(Tavern.__table__.insert().values(addr=addr, join_time=now))
+        changes = [_ledger_row(addr, -BET, "tavern")]
+        result, game = "joined", {}
+    return result, game, changes
+
+
+def _play_tournament(session, cond: list, bet: int) -> Tuple[List[str], Optional[str]]:
+    """Take the bet from all the users matching cond and give the pot to the winner.
+
+    Users are read in chunks sorted by address and every user rolls 5 dices,
+    ties for the highest roll are resolved randomly.
+    Returns the participants and the winner's address.
+    """
+    addrs: List[str] = []
+    winner_addr = None
+    winner_roll = 0
+    ties = 0
+    last = ""
+    while True:
+        chunk = [
+            addr
+            for (addr,) in session.query(User.addr)
+            .filter(User.addr > last, *cond)
+            .order_by(User.addr)
+            .limit(TOURNAMENT_CHUNK)
+        ]
+        if not chunk:
+            break
+        last = chunk[-1]
+        _write_ledger(
+            session, [_ledger_row(addr, -bet, "tournament") for addr in chunk]
+        )
+        addrs.extend(chunk)
+        rolls = _roll_sums(len(chunk))
+        best = max(rolls)
+        if best < winner_roll:
+            continue
+        best_addrs = [addr for addr, roll in zip(chunk, rolls) if roll == best]
+        if best > winner_roll:
+            winner_roll, ties = best, 0
+        # reservoir sampling so every tied player has the same chance to win
+        ties += len(best_addrs)
+        if random.randrange(ties) < len(best_addrs):
+            winner_addr = random.choice(best_addrs)
+    if winner_addr:
+        _write_ledger(
+            session, [_ledger_row(winner_addr, bet * len(addrs), "tournament win")]
+        )
+    return addrs, winner_addr
+
+
+def _get_score(session, addr: str) -> int:
+    return session.query(User.score).filter_by(addr=addr).scalar() or 0
+
+
+def _ledger_row(addr: str, delta: int, reason: str) -> dict:
+    return dict(addr=addr, delta=delta, reason=reason, time=time.time())
+
+
+def _write_ledger(session, rows: List[dict]) -> None:
+    """Append the given rows to the ledger and apply them to the users' score."""
+    session.bulk_insert_mappings(ScoreLedger, rows)
+    deltas: Dict[str, int] = {}
+    for row in rows:
+        deltas[row["addr"]] = deltas.get(row["addr"], 0) + row["delta"]
+    params = [dict(_addr=addr, _delta=delta) for addr, delta in deltas.items() if delta]
+    if params:
+        table = User.__table__
+        session.execute(
+            table.update()
+            .where(table.c.addr == bindparam("_addr"))
+            .values(score=table.c.score + bindparam("_delta")),
+            params,
+        )
+
+
+def _roll_sums(count: int, dices: int = 5) -> list:
+    """Get the sum of rolling the given number of dices, count times."""
+    if np is not None:
+        return np.random.randint(1, 7, size=(count, dices)).sum(axis=1).tolist()
+    return [sum(_roll_dice(dices)) for _ in range(count)]
+
+
+def _send_later(bot: DeltaBot, messages: List[Tuple[str, str]]) -> None:
+    """Queue the given (addr, text) notifications to be sent in batches."""
+    with outbox_lock:
+        outbox.extend(messages)
+        if outbox and not outbox_job["job"]:
+            outbox_job["job"] = scheduler.at(
+                time.time(), _flush_outbox, bot, name="dice.outbox"
             )
-        else:
-            chat = bot.get_chat(user2.addr)
-            if session.query(Tavern).filter_by(addr=user2.addr).first():
-                replies.add(text="❌ Ya estás en la taberna", chat=chat)
-            else:
-                user2.score -= BET
-                player = Tavern(addr=user2.addr, join_time=time.time())
-                session.add(player)
-                replies.add(
-                    text=f"🍺 Entras a la taberna, tomas asiento y saboreas tu bebida mientras esperas en los próximos {TAVERN_COOLDOWN // 60} minutos a que algún oponente aparezca para jugar dados",
-                    chat=chat,
+
+
+def _flush_outbox(bot: DeltaBot) -> None:
+    """Send the next batch of queued notifications.
+
+    The job is scheduled again while the outbox is not empty.
+    """
+    try:
+        for _ in range(OUTBOX_BATCH):
+            try:
+                addr, text = outbox.popleft()
+            except IndexError:
+                break
+            try:
+                bot.get_chat(addr).send_text(text)
+            except Exception as err:
+                bot.logger.exception(err)
+    finally:
+        with outbox_lock:
+            outbox_job["job"] = None
+            if outbox:
+                outbox_job["job"] = scheduler.at(
+                    time.time() + OUTBOX_INTERVAL,
+                    _flush_outbox,
+                    bot,
+                    name="dice.outbox",
                 )
 
 
+def _tavern_rolls() -> Tuple[tuple, tuple]:
+    """Roll the dices of both players until one of them wins."""
+    roll1 = _roll_dice()
+    roll2 = _roll_dice()
+    while sum(roll1) == sum(roll2):
+        roll1 = _roll_dice()
+        roll2 = _roll_dice()
+    return roll1, roll2
+
+
 def _roll_dice(n=2) -> tuple:
     return tuple(random.randint(1, 6) for _ in range(n))
 
 
-def _get_opponent(addr: str, session) -> Optional[User]:
-    for player in session.query(Tavern):
-        if player.addr == addr:
-            continue
-        session.delete(player)
-        return session.query(User).filter_by(addr=player.addr).one()
+def _get_opponent(addr: str, session, score: int = 0) -> Optional[Tuple[str, int]]:
+    """Take the player that has been waiting the longest out of the tavern.
+
+    Returns the player's address and score.
+    """
+    query = (
+        session.query(Tavern.addr, User.score)
+        .join(User, User.addr == Tavern.addr)
+        .filter(Tavern.addr != addr)
+        .order_by(Tavern.join_time)
+    )
+    queries = [query]
+    if SCORE_BRACKET:
+        queries.insert(
+            0,
+            query.filter(
+                User.score.between(score - SCORE_BRACKET, score + SCORE_BRACKET)
+            ),
+        )
+    for query in queries:
+        while True:
+            row = query.first()
+            if not row:
+                break
+            # if other process took the player already, try with the next one
+            deleted = (
+                session.query(Tavern)
+                .filter_by(addr=row[0])
+                .delete(synchronize_session=False)
+            )
+            if deleted:
+                return row[0], row[1]
     return None
 
 
+def _schedule_tavern_check(bot: DeltaBot) -> None:
+    """Make sure a check is scheduled for the next player that must leave."""
+    with tavern_lock:
+        if not tavern_heap:
+            return
+        deadline = tavern_heap[0][0]
+        job = tavern_check["job"]
+        if job and not job.cancelled and tavern_check["deadline"] <= deadline:
+            return
+        if job:
+            job.cancel()
+        tavern_check["deadline"] = deadline
+        tavern_check["job"] = scheduler.at(
+            deadline, _check_tavern, bot, name="dice.check_tavern"
+        )
+
+
 def _check_tavern(bot: DeltaBot) -> None:
+    """Refund the players that waited too long in the tavern."""
+    now = time.time()
+    with tavern_lock:
+        tavern_check["job"] = None
+        addrs = []
+        while tavern_heap and tavern_heap[0][0] <= now:
+            addrs.append(heapq.heappop(tavern_heap)[1])
+    try:
+        expired = _expire_players(addrs, now) if addrs else []
+    except Exception:
+        with tavern_lock:  # retry later
+            for addr in addrs:
+                heapq.heappush(tavern_heap, (now + 60, addr))
+        _schedule_tavern_check(bot)
+        raise
     badge = _getdefault(bot, "score_badge", "🎖️")
-    while True:
-        try:
-            time.sleep(10)
-            with session_scope() as session:
-                for player in session.query(Tavern):
-                    if time.time() - player.join_time > TAVERN_COOLDOWN:
-                        user = session.query(User).filter_by(addr=player.addr).one()
-                        session.delete(player)
-                        user.score += BET
-                        bot.get_chat(user.addr).send_text(
-                            f"+{BET}{badge} Sales de la taberna sin que nada interesante pase."
-                        )
-        except Exception as err:
-            bot.logger.exception(err)
+    for addr in expired:
+        bot.get_chat(addr).send_text(
+            f"+{BET}{badge} Sales de la taberna sin que nada interesante pase."
+        )
+    _schedule_tavern_check(bot)
+
+
+def _expire_players(addrs: List[str], now: float) -> List[str]:
+    with matchmaking_lock:
+        with session_scope() as session:
+            # players already matched or that joined again are not expired
+            expired = [
+                addr
+                for (addr,) in session.query(Tavern.addr).filter(
+                    Tavern.addr.in_(addrs), Tavern.join_time <= now - TAVERN_COOLDOWN
+                )
+            ]
+            if expired:
+                session.query(Tavern).filter(Tavern.addr.in_(expired)).delete(
+                    synchronize_session=False
+                )
+                _write_ledger(
+                    session,
+                    [_ledger_row(addr, BET, "tavern refund") for addr in expired],
+                )
+    return expired
@@ -1,9 +1,24 @@
+"""Image search.
+
+optional requirements:
+Pillow (to downscale and recompress the images before sending them)
+lxml (faster HTML parsing, html5lib is used otherwise)
+"""
+
 import functools
+import hashlib
 import io
+import json
 import mimetypes
+import os
 import random
 import re
-from typing import Generator
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
+from typing import Any, Callable, Deque, Dict, Generator, List, Optional, Tuple
 from urllib.parse import quote, quote_plus
 
 import bs4
@@ -12,6 +27,13 @@ import simplebot
 from deltachat import Message
 from simplebot.bot import DeltaBot, Replies
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # type: ignore
+
+MAX_IMAGE_SIZE = 1024 * 1024 * 2
+
 session = requests.Session()
 session.headers.update(
     {
@@ -19,6 +41,194 @@ session.headers.update(
     }
 )
 session.request = functools.partial(session.request, timeout=15)  # type: ignore
+search_pool = ThreadPoolExecutor(max_workers=6, thread_name_prefix="image_search")
+download_pool = ThreadPoolExecutor(max_workers=10, thread_name_prefix="image_download")
+links_cache: Optional["LinksCache"] = None
+provider_stats: Dict[str, "ProviderStats"] = {}
+compression_stats = {"images": 0, "saved": 0}
+compression_lock = Lock()
+ImageHash = Tuple[str, Optional[int]]
+
+
+class HashIndex:
+    """Bounded index of the hashes of recently downloaded images per query."""
+
+    def __init__(self, max_queries: int = 1000, max_urls: int = 50) -> None:
+        self.max_queries = max_queries
+        self.max_urls = max_urls
+        self._index: Dict[str, OrderedDict] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, query: str, url: str) -> Optional[ImageHash]:
+        with self._lock:
+            urls = self._index.get(_normalize_query(query))
+            return urls.get(url) if urls else None
+
+    def add(self, query: str, url: str, img_hash: ImageHash) -> None:
+        query = _normalize_query(query)
+        with self._lock:
+            urls = self._index.pop(query, None) or OrderedDict()
+            self._index[query] = urls
+            urls.pop(url, None)
+            urls[url] = img_hash
+            if len(urls) > self.max_urls:
+                urls.popitem(last=False)
+            if len(self._index) > self.max_queries:
+                self._index.popitem(last=False)  # type: ignore
+
+
+hash_index = HashIndex()
+
+
+class ProviderStats:
+    """Health statistics of an image provider with a simple circuit breaker.
+
+    After ``max_failures`` consecutive failures (errors or no links returned)
+    the circuit opens and the provider is skipped for ``cooldown`` seconds,
+    after that a single failure is enough to open it again.
+    """
+
+    max_failures = 3
+    cooldown = 60 * 10
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.successes = 0
+        self.links = 0
+        self.latency = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = Lock()
+
+    @property
+    def success_rate(self) -> float:
+        return (self.successes + 1) / (self.calls + 2)
+
+    @property
+    def avg_latency(self) -> float:
+        return self.latency / self.calls if self.calls else 0.0
+
+    def is_open(self) -> bool:
+        return time.time() < self.open_until
+
+    def record(self, links: int, latency: float) -> None:
+        with self._lock:
+            self.calls += 1
+            self.latency += latency
+            self.links += links
+            if links:
+                self.successes += 1
+                self.failures = 0
+                self.open_until = 0.0
+            else:
+                self.failures += 1
+                if self.failures >= self.max_failures:
+                    self.open_until = time.time() + self.cooldown
+
+    def __str__(self) -> str:
+        text = (
+            f"{self.name}: {self.successes}/{self.calls} ok,"
+            f" {self.avg_latency:.1f}s avg, {self.links} links"
+        )
+        if self.is_open():
+            text += f" (disabled {int(self.open_until - time.time())}s)"
+        return text
+
+
+class LinksCache:
+    """Persistent cache of the links returned by the image providers.
+
+    Entries are keyed by normalized query and provider name, they expire after
+    ``ttl`` seconds and the least recently used ones are evicted once the cache
+    has more than ``max_entries`` entries.
+    """
+
+    def __init__(self, path: str, ttl: int, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS links (
+                query TEXT,
+                provider TEXT,
+                links TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY(query, provider))"""
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS links_accessed ON links(accessed)"
+            )
+
+    def get(self, query: str, provider: str) -> Optional[list]:
+        now = time.time()
+        key = (_normalize_query(query), provider)
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT links, created FROM links WHERE query=? AND provider=?", key
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM links WHERE query=? AND provider=?", key)
+                return None
+            self._db.execute(
+                "UPDATE links SET accessed=? WHERE query=? AND provider=?",
+                (now, *key),
+            )
+        links = json.loads(row[0])
+        random.shuffle(links)
+        return links
+
+    def set(self, query: str, provider: str, links: set) -> None:
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "REPLACE INTO links VALUES (?,?,?,?,?)",
+                (_normalize_query(query), provider, json.dumps(list(links)), now, now),
+            )
+            self._db.execute(
+                "DELETE FROM links WHERE rowid IN (SELECT rowid FROM links"
+                " ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+@simplebot.hookimpl
+def deltabot_init(bot: DeltaBot) -> None:
+    _getdefault(bot, "max_image_size", str(MAX_IMAGE_SIZE))
+    _getdefault(bot, "cache_ttl", str(60 * 60 * 24))
+    _getdefault(bot, "cache_size", "5000")
+    _getdefault(bot, "max_dimension", "1280")
+    _getdefault(bot, "image_quality", "75")
+    _getdefault(bot, "image_format", "jpeg")
+    _getdefault(bot, "compress_min_size", str(1024 * 100))
+
+
+@simplebot.hookimpl
+def deltabot_start(bot: DeltaBot) -> None:
+    global links_cache
+    path = os.path.join(os.path.dirname(bot.account.db_path), "image_search.db")
+    links_cache = LinksCache(
+        path,
+        int(_getdefault(bot, "cache_ttl")),
+        int(_getdefault(bot, "cache_size")),
+    )
+
+
+@simplebot.command(name="/imageStats", admin=True)
+def image_stats(replies: Replies) -> None:
+    """Get statistics about the image search providers."""
+    lines = [str(stats) for stats in provider_stats.values()]
+    if compression_stats["images"]:
+        lines.append(
+            f"\nRecompressed {compression_stats['images']} images,"
+            f" saved {compression_stats['saved'] // 1024}KiB"
+        )
+    replies.add(text="\n".join(lines) or "❌ No searches yet")
 
 
 @simplebot.command
@@ -47,48 +257,274 @@ def _image_cmd(
     if not payload:
         replies.add(text="❌ No text given", quote=message)
         return
-    imgs = img_count
-    for filename, data in _get_images(bot, payload):
+    imgs = 0
+    for filename, data in _get_images(bot, payload, img_count):
         replies.add(filename=filename, bytefile=io.BytesIO(data))
-        imgs -= 1
-        if imgs <= 0:
-            break
-    if imgs == img_count:
+        imgs += 1
+    if not imgs:
         replies.add(text="❌ No results", quote=message)
 
 
-def _get_images(bot: DeltaBot, query: str) -> Generator:
-    img_providers = [_google_imgs, _startpage_imgs, _dogpile_imgs]
-    img_providers_low = [_alphacoders, _unsplash, _everypixel]
-    while img_providers:
-        provider = random.choice(img_providers)
-        img_providers.remove(provider)
+def _get_images(bot: DeltaBot, query: str, img_count: int) -> Generator:
+    """Query all providers of a tier at once, lower tiers only if needed.
+
+    Image URLs are downloaded concurrently as soon as a provider returns them
+    and images are yielded in the order the downloads complete. Only a few
+    downloads per request are in flight at once so a single request doesn't
+    take all the download workers.
+    """
+    max_size = int(_getdefault(bot, "max_image_size", str(MAX_IMAGE_SIZE)))
+    compress = _get_compress_options(bot)
+    tiers = (
+        [_google_imgs, _startpage_imgs, _dogpile_imgs],
+        [_alphacoders, _unsplash, _everypixel],
+    )
+    seen = set()
+    hashes: List[ImageHash] = []
+    expected: List[ImageHash] = []
+    searches: dict = {}
+    downloads: dict = {}
+    pending: Deque[str] = deque()
+
+    def is_duplicate(img_hash: ImageHash) -> bool:
+        return _is_duplicate(img_hash, hashes)
+
+    def submit_downloads() -> None:
+        while pending and len(downloads) < img_count * 2:
+            img_url = pending.popleft()
+            img_hash = hash_index.get(query, img_url)
+            if img_hash:
+                if _is_duplicate(img_hash, hashes + expected):
+                    continue
+                expected.append(img_hash)
+            future = download_pool.submit(
+                _fetch_image, img_url, max_size, compress, is_duplicate
+            )
+            downloads[future] = img_url
+
+    try:
+        for providers in tiers:
+            for provider in _rank_providers(providers):
+                bot.logger.debug("Trying %s", provider)
+                searches[search_pool.submit(_search, provider, query)] = provider
+            while searches or downloads or pending:
+                submit_downloads()
+                if not searches and not downloads:
+                    break
+                done, _ = wait(
+                    list(searches) + list(downloads), return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    if future in searches:
+                        provider = searches.pop(future)
+                        try:
+                            links = future.result()
+                        except Exception as err:
+                            bot.logger.exception(err)
+                            continue
+                        bot.logger.debug("%s returned %s links", provider, len(links))
+                        for img_url in links:
+                            if img_url not in seen:
+                                seen.add(img_url)
+                                pending.append(img_url)
+                        continue
+                    img_url = downloads.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        bot.logger.debug("Failed to download %s: %s", img_url, err)
+                        continue
+                    if result:
+                        filename, data, img_hash = result
+                        hash_index.add(query, img_url, img_hash)
+                        if _is_duplicate(img_hash, hashes):
+                            bot.logger.debug("Skipping duplicated image %s", img_url)
+                            continue
+                        hashes.append(img_hash)
+                        yield filename, data
+                        img_count -= 1
+                        if img_count <= 0:
+                            return
+    finally:
+        for future in list(searches) + list(downloads):
+            future.cancel()
+
+
+def _search(provider: Callable, query: str) -> list:
+    if links_cache:
+        links = links_cache.get(query, provider.__name__)
+        if links is not None:
+            return links
+    stats = _get_stats(provider)
+    start = time.time()
+    try:
+        links = provider(query)
+    except Exception:
+        stats.record(0, time.time() - start)
+        raise
+    stats.record(len(links), time.time() - start)
+    if links and links_cache:
+        links_cache.set(query, provider.__name__, links)
+    return list(links)
+
+
+def _get_stats(provider: Callable) -> ProviderStats:
+    stats = provider_stats.get(provider.__name__)
+    if stats is None:
+        stats = provider_stats.setdefault(
+            provider.__name__, ProviderStats(provider.__name__)
+        )
+    return stats
+
+
+def _rank_providers(providers: List[Callable]) -> List[Callable]:
+    """Sort providers by success rate and latency, skipping disabled ones."""
+    ranked = []
+    for provider in providers:
+        stats = _get_stats(provider)
+        if not stats.is_open():
+            ranked.append(
+                (-stats.success_rate, stats.avg_latency, random.random(), provider)
+            )
+    ranked.sort(key=lambda item: item[:3])
+    return [item[-1] for item in ranked]
+
+
+def _normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def _get_compress_options(bot: DeltaBot) -> Optional[dict]:
+    max_dimension = int(_getdefault(bot, "max_dimension", "1280"))
+    if Image is None or max_dimension <= 0:
+        return None
+    return dict(
+        max_dimension=max_dimension,
+        quality=int(_getdefault(bot, "image_quality", "75")),
+        fmt=_getdefault(bot, "image_format", "jpeg").lower(),
+        min_size=int(_getdefault(bot, "compress_min_size", str(1024 * 100))),
+    )
+
+
+def _fetch_image(
+    url: str,
+    max_size: int,
+    compress: Optional[dict],
+    is_duplicate: Callable[[ImageHash], bool],
+) -> Optional[Tuple[str, bytes, ImageHash]]:
+    result = _download_image(url, max_size)
+    if not result:
+        return None
+    img_hash = _hash_image(result[1])
+    # duplicates are dropped anyway, don't waste time compressing them
+    if compress and not is_duplicate(img_hash):
         try:
-            bot.logger.debug("Trying %s", provider)
-            for img_url in provider(query):
-                with session.get(img_url) as resp:
-                    resp.raise_for_status()
-                    filename = "image" + (get_extension(resp) or ".jpg")
-                    yield filename, resp.content
-        except Exception as err:
-            bot.logger.exception(err)
-        if not img_providers and img_providers_low:
-            img_providers.extend(img_providers_low)
-            img_providers_low.clear()
+            result = _compress_image(*result, **compress)
+        except Exception:  # not an image Pillow understands, send as is
+            pass
+    return (*result, img_hash)
+
+
+def _hash_image(data: bytes) -> ImageHash:
+    """Get the SHA1 digest and a perceptual difference hash of the image."""
+    digest = hashlib.sha1(data).hexdigest()
+    if Image is None:
+        return digest, None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.draft("L", (32, 32))
+            pixels = list(img.convert("L").resize((9, 8)).getdata())
+    except Exception:
+        return digest, None
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            index = row * 9 + col
+            dhash = dhash << 1 | (pixels[index] > pixels[index + 1])
+    return digest, dhash
+
+
+def _is_duplicate(img_hash: ImageHash, hashes: List[ImageHash]) -> bool:
+    digest, dhash = img_hash
+    for digest2, dhash2 in hashes:
+        if digest == digest2:
+            return True
+        if dhash is not None and dhash2 is not None:
+            if bin(dhash ^ dhash2).count("1") <= 4:
+                return True
+    return False
+
+
+def _compress_image(
+    filename: str,
+    data: bytes,
+    max_dimension: int,
+    quality: int,
+    fmt: str,
+    min_size: int,
+) -> Tuple[str, bytes]:
+    if len(data) <= min_size or filename.endswith(".gif"):
+        return filename, data
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail((max_dimension, max_dimension))
+        if fmt == "jpeg" and img.mode != "RGB":
+            img = _flatten_image(img)
+        buffer = io.BytesIO()
+        img.save(buffer, format=fmt, quality=quality, optimize=True)
+    if buffer.tell() >= len(data):
+        return filename, data
+    with compression_lock:
+        compression_stats["images"] += 1
+        compression_stats["saved"] += len(data) - buffer.tell()
+    ext = ".jpg" if fmt == "jpeg" else f".{fmt}"
+    return "image" + ext, buffer.getvalue()
+
+
+def _flatten_image(img):
+    """Convert the image to RGB, with a white background if it is transparent."""
+    if img.mode in ("LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+    if img.mode != "RGBA":
+        return img.convert("RGB")
+    background = Image.new("RGB", img.size, "white")
+    background.paste(img, mask=img.getchannel("A"))
+    return background
+
+
+def _download_image(url: str, max_size: int) -> Optional[Tuple[str, bytes]]:
+    with session.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        ctype = resp.headers.get("content-type", "").split(";")[0].strip().lower()
+        if ctype and not ctype.startswith("image/"):
+            return None
+        if int(resp.headers.get("content-length") or 0) > max_size:
+            return None
+        data = bytearray()
+        for chunk in resp.iter_content(chunk_size=1024 * 64):
+            data.extend(chunk)
+            if len(data) > max_size:
+                return None
+        if not data:
+            return None
+        return "image" + (get_extension(resp) or ".jpg"), bytes(data)
 
 
 def _google_imgs(query: str) -> set:
     url = f"https://www.google.com/search?tbm=isch&sout=1&q={quote_plus(query)}"
     with session.get(url) as resp:
         resp.raise_for_status()
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    links = set()
-    for table in soup("table"):
-        for img in table("img"):
-            if img["src"].startswith("data:"):
-                continue
-            links.add(img["src"])
-    return links
+        html = resp.text
+
+    def extract(soup: bs4.BeautifulSoup) -> set:
+        links = set()
+        for table in soup("table"):
+            for img in table("img"):
+                if img["src"].startswith("data:"):
+                    continue
+                links.add(img["src"])
+        return links
+
+    return _parse(html, extract, bs4.SoupStrainer("table"))
 
 
 def _startpage_imgs(query: str) -> set:
@@ -96,77 +532,122 @@ def _startpage_imgs(query: str) -> set:
     with session.get(url) as resp:
         resp.raise_for_status()
         url = resp.url
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
+        html = resp.text
     index = url.find("/", 8)
     if index == -1:
         root = url
     else:
         root = url[:index]
         url = url.rsplit("/", 1)[0]
-    links = set()
-    for div in soup(class_="image-container"):
-        if not div.img or div.img.startswith("data:"):
-            continue
-        img = re.sub(r"^(//.*)", rf"{root.split(':', 1)[0]}:\1", div.img)
-        img = re.sub(r"^(/.*)", rf"{root}\1", img)
-        if not re.match(r"^https?://", img):
-            img = f"{url}/{img}"
-        links.add(img)
-    return links
+
+    def extract(soup: bs4.BeautifulSoup) -> set:
+        links = set()
+        for div in soup(class_="image-container"):
+            if not div.img or div.img.startswith("data:"):
+                continue
+            img = re.sub(r"^(//.*)", rf"{root.split(':', 1)[0]}:\1", div.img)
+            img = re.sub(r"^(/.*)", rf"{root}\1", img)
+            if not re.match(r"^https?://", img):
+                img = f"{url}/{img}"
+            links.add(img)
+        return links
+
+    return _parse(html, extract, bs4.SoupStrainer(class_="image-container"))
 
 
 def _alphacoders(query: str) -> set:
     url = f"https://pics.alphacoders.com/search?t={quote_plus(query)}"
     with session.get(url) as resp:
         resp.raise_for_status()
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    links = set()
-    for tag in soup("img", class_="img-thumb"):
-        if tag["src"].startswith("data:"):
-            continue
-        links.add(tag["src"])
-    return links
+        html = resp.text
+
+    def extract(soup: bs4.BeautifulSoup) -> set:
+        links = set()
+        for tag in soup("img", class_="img-thumb"):
+            if tag["src"].startswith("data:"):
+                continue
+            links.add(tag["src"])
+        return links
+
+    return _parse(html, extract, bs4.SoupStrainer("img", class_="img-thumb"))
 
 
 def _unsplash(query: str) -> set:
     url = f"https://unsplash.com/s/photos/{quote(query)}"
     with session.get(url) as resp:
         resp.raise_for_status()
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    links = set()
-    for tag in soup("img", itemprop="thumbnailUrl"):
-        if tag["src"].startswith("data:"):
-            continue
-        links.add(tag["src"])
-    return links
+        html = resp.text
+
+    def extract(soup: bs4.BeautifulSoup) -> set:
+        links = set()
+        for tag in soup("img", itemprop="thumbnailUrl"):
+            if tag["src"].startswith("data:"):
+                continue
+            links.add(tag["src"])
+        return links
+
+    return _parse(html, extract, bs4.SoupStrainer("img", itemprop="thumbnailUrl"))
 
 
 def _everypixel(query: str) -> set:
     url = f"https://www.everypixel.com/search?meaning=&stocks_type=free&media_type=0&page=1&q={quote_plus(query)}"
     with session.get(url) as resp:
         resp.raise_for_status()
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    links = set()
-    for tag in soup(class_="thumb"):
-        if tag.img["src"].startswith("data:"):
-            continue
-        links.add(tag.img["src"])
-    return links
+        html = resp.text
+
+    def extract(soup: bs4.BeautifulSoup) -> set:
+        links = set()
+        for tag in soup(class_="thumb"):
+            if tag.img["src"].startswith("data:"):
+                continue
+            links.add(tag.img["src"])
+        return links
+
+    return _parse(html, extract, bs4.SoupStrainer(class_="thumb"))
 
 
 def _dogpile_imgs(query: str) -> set:
     url = f"https://www.dogpile.com/search/images?q={quote_plus(query)}"
     with session.get(url) as resp:
         resp.raise_for_status()
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    soup = soup.find("div", class_="mainline-results")
-    if not soup:
-        return set()
-    links = set()
-    for anchor in soup("a"):
-        if anchor.img:
-            links.add(anchor["href"])
-    return links
+        html = resp.text
+
+    def extract(soup: bs4.BeautifulSoup) -> set:
+        soup = soup.find("div", class_="mainline-results")
+        if not soup:
+            return set()
+        links = set()
+        for anchor in soup("a"):
+            if anchor.img:
+                links.add(anchor["href"])
+        return links
+
+    return _parse(html, extract, bs4.SoupStrainer("div", class_="mainline-results"))
+
+
+def _parse(
+    html: str, extract: Callable, parse_only: Optional[bs4.SoupStrainer] = None
+) -> Any:
+    """Extract data from the given HTML using the fastest parser available.
+
+    The document is parsed with lxml, limited to the tags matching parse_only,
+    and only if that finds nothing it is parsed again with html5lib.
+    """
+    try:
+        result = extract(bs4.BeautifulSoup(html, "lxml", parse_only=parse_only))
+        if result:
+            return result
+    except Exception:  # lxml missing or it didn't parse the page as expected
+        pass
+    return extract(bs4.BeautifulSoup(html, "html5lib"))
+
+
+def _getdefault(bot: DeltaBot, key: str, value: str = None) -> str:
+    val = bot.get(key, scope=__name__)
+    if val is None and value is not None:
+        bot.set(key, value, scope=__name__)
+        val = value
+    return val
 
 
 def get_extension(resp: requests.Response) -> str:
@@ -0,0 +1,182 @@
+"""Latency and error statistics for all the bot's commands and filters.
+
+Set the "prometheus_file" setting to a file path to periodically export the
+statistics in Prometheus' text format.
+"""
+
+import functools
+import os
+import threading
+import time
+from typing import Callable, Dict, List
+
+import simplebot
+from simplebot.bot import DeltaBot, Replies
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+EXPORT_INTERVAL = 60
+local = threading.local()
+handlers: Dict[str, "HandlerStats"] = {}
+
+
+class HandlerStats:
+    """Call counters and latency histogram of a command or filter."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.http_time = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self._lock = threading.Lock()
+
+    def record(self, took: float, http_time: float, failed: bool) -> None:
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+            self.total_time += took
+            self.http_time += http_time
+            for i, bound in enumerate(BUCKETS):
+                if took <= bound:
+                    self.buckets[i] += 1
+                    break
+
+    def percentile(self, percent: float) -> float:
+        """Get the upper bound of the bucket containing the given percentile."""
+        rank = self.calls * percent
+        count = 0
+        for bound, hits in zip(BUCKETS, self.buckets):
+            count += hits
+            if count >= rank:
+                return bound
+        return BUCKETS[-1]
+
+    def __str__(self) -> str:
+        avg = self.total_time / self.calls if self.calls else 0
+        http = self.http_time / self.total_time * 100 if self.total_time else 0
+        return (
+            f"{self.name}: {self.calls} calls, {self.errors} errors,"
+            f" {avg:.2f}s avg, p95<={self.percentile(0.95)}s, {http:.0f}% HTTP"
+        )
+
+
+@simplebot.hookimpl
+def deltabot_init(bot: DeltaBot) -> None:
+    _getdefault(bot, "prometheus_file", "")
+
+
+@simplebot.hookimpl(trylast=True)
+def deltabot_start(bot: DeltaBot) -> None:
+    for name, cmd_def in bot.commands.dict().items():
+        cmd_def.func = _instrument(name, cmd_def.func)
+    for name, filter_def in bot.filters.dict().items():
+        filter_def.func = _instrument(name, filter_def.func)
+    _instrument_requests()
+    if _getdefault(bot, "prometheus_file"):
+        threading.Thread(target=_export_loop, args=(bot,), daemon=True).start()
+
+
+@simplebot.command(name="/cmdStats", admin=True)
+def cmd_stats(replies: Replies) -> None:
+    """Get call count, latency and errors of the bot's commands and filters."""
+    stats = sorted(handlers.values(), key=lambda s: s.total_time, reverse=True)
+    text = "\n\n".join(str(s) for s in stats if s.calls)
+    replies.add(text=text or "❌ Nothing called yet")
+
+
+def _instrument(name: str, func: Callable) -> Callable:
+    if hasattr(func, "__instrumented__"):
+        return func
+    stats = handlers.setdefault(name, HandlerStats(name))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        local.http_time = 0.0
+        failed = True
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            stats.record(time.perf_counter() - start, local.http_time, failed)
+
+    wrapper.__instrumented__ = True  # type: ignore
+    return wrapper
+
+
+def _instrument_requests() -> None:
+    """Account the time spent in HTTP requests to the calling handler.
+
+    Only requests done in the handler's own thread are accounted.
+    """
+    try:
+        import requests
+    except ImportError:
+        return
+    send = requests.Session.send
+    if hasattr(send, "__instrumented__"):
+        return
+
+    @functools.wraps(send)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return send(*args, **kwargs)
+        finally:
+            local.http_time = getattr(local, "http_time", 0.0) + (
+                time.perf_counter() - start
+            )
+
+    wrapper.__instrumented__ = True  # type: ignore
+    requests.Session.send = wrapper  # type: ignore
+
+
+def _export_loop(bot: DeltaBot) -> None:
+    while True:
+        time.sleep(EXPORT_INTERVAL)
+        try:
+            path = _getdefault(bot, "prometheus_file")
+            if path:
+                with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+                    file.write(_to_prometheus())
+                os.replace(f"{path}.tmp", path)
+        except Exception as err:
+            bot.logger.exception(err)
+
+
+def _to_prometheus() -> str:
+    stats = list(handlers.values())
+    labels = [
+        'handler="{}"'.format(s.name.replace("\\", "\\\\").replace('"', '\\"'))
+        for s in stats
+    ]
+    lines: List[str] = ["# TYPE simplebot_handler_seconds histogram"]
+    for label, stat in zip(labels, stats):
+        count = 0
+        for bound, hits in zip(BUCKETS, stat.buckets):
+            count += hits
+            le = "+Inf" if bound == float("inf") else bound
+            lines.append(
+                f'simplebot_handler_seconds_bucket{{{label},le="{le}"}} {count}'
+            )
+        lines.append(f"simplebot_handler_seconds_sum{{{label}}} {stat.total_time}")
+        lines.append(f"simplebot_handler_seconds_count{{{label}}} {stat.calls}")
+    lines.append("# TYPE simplebot_handler_errors_total counter")
+    for label, stat in zip(labels, stats):
+        lines.append(f"simplebot_handler_errors_total{{{label}}} {stat.errors}")
+    lines.append("# TYPE simplebot_handler_http_seconds_total counter")
+    for label, stat in zip(labels, stats):
+        lines.append(
+            f"simplebot_handler_http_seconds_total{{{label}}} {stat.http_time}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def _getdefault(bot: DeltaBot, key: str, value: str = None) -> str:
+    val = bot.get(key, scope=__name__)
+    if val is None and value is not None:
+        bot.set(key, value, scope=__name__)
+        val = value
+    return val
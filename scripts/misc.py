@@ -1,16 +1,40 @@
-"""Miscellaneous small commands and filters."""
+"""Miscellaneous small commands and filters.
+
+optional requirements:
+lxml (faster HTML parsing, html5lib is used otherwise)
+"""
 
 import functools
 import io
+import json
+import logging
 import random
 import re
-from datetime import datetime, timedelta
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Deque, Dict, Optional
 from urllib.parse import quote
 
 import bs4
 import requests
 import simplebot
 
+try:
+    from zoneinfo import ZoneInfo
+
+    DRAW_TZ: Any = ZoneInfo("America/New_York")
+except Exception:  # Python < 3.9 or no tz database
+    DRAW_TZ = timezone(timedelta(hours=-5))
+DRAW_TIMES = ((13, 30), (21, 45))  # Florida lottery draws (Eastern Time)
+DRAW_GRACE = 60 * 10  # time for the results to be published after a draw
+DRAW_WINDOW = 60 * 60 * 2  # keep checking for new results during this window
+DRAW_RETRY = 60 * 5
+WTTR_TTL = 60 * 10
+WTTR_CACHE_SIZE = 1024 * 1024 * 5
+
 session = requests.Session()
 session.headers.update(
     {
@@ -20,6 +44,244 @@ session.headers.update(
 session.request = functools.partial(session.request, timeout=30)  # type: ignore
 
 
+class Prefetcher:
+    """Buffers of ready to send texts, refilled by a background worker.
+
+    Each source keeps up to ``size`` texts, texts seen in the last ``history``
+    fetches of a source are discarded to avoid serving repeats.
+    """
+
+    def __init__(self, size: int = 10, history: int = 100) -> None:
+        self.size = size
+        self.sources: Dict[str, Callable[[], str]] = {}
+        self.buffers: Dict[str, Deque[str]] = {}
+        self.recent: Dict[str, Deque[str]] = {}
+        self.history = history
+        self._lock = Lock()
+        self._wakeup = Event()
+
+    def register(self, name: str, fetch: Callable[[], str]) -> None:
+        self.sources[name] = fetch
+        self.buffers[name] = deque()
+        self.recent[name] = deque(maxlen=self.history)
+
+    def pop(self, name: str) -> Optional[str]:
+        with self._lock:
+            buffer = self.buffers[name]
+            text = buffer.popleft() if buffer else None
+        self._wakeup.set()
+        return text
+
+    def dump(self) -> str:
+        with self._lock:
+            return json.dumps({name: list(buf) for name, buf in self.buffers.items()})
+
+    def load(self, data: str) -> None:
+        with self._lock:
+            for name, texts in json.loads(data).items():
+                if name in self.buffers:
+                    self.buffers[name].extend(texts[: self.size])
+                    self.recent[name].extend(texts)
+
+    def run(self, logger) -> None:
+        while True:
+            full = True
+            for name, fetch in self.sources.items():
+                full = self._fill(name, fetch, logger) and full
+            # wake up when something is consumed or to retry failed sources
+            self._wakeup.wait(None if full else 60)
+            self._wakeup.clear()
+
+    def _fill(self, name: str, fetch: Callable[[], str], logger) -> bool:
+        buffer, recent = self.buffers[name], self.recent[name]
+        for _ in range(self.size * 2):
+            if len(buffer) >= self.size:
+                return True
+            try:
+                text = fetch()
+            except Exception as ex:
+                logger.debug("Failed to prefetch %s: %s", name, ex)
+                return False
+            with self._lock:
+                if text and text not in recent:
+                    recent.append(text)
+                    buffer.append(text)
+        return len(buffer) >= self.size
+
+
+class DrawCache:
+    """Cache of replies that only change after the lottery draws.
+
+    Replies are reused until the next draw, after it they are revalidated with
+    conditional requests every few minutes until the new results are found.
+    If upstream fails the last reply is served until it can be revalidated.
+    """
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.sources: Dict[str, tuple] = {}
+        self._entries: Dict[str, dict] = {}
+        self._locks: Dict[str, Lock] = {}
+
+    def register(self, key: str, url: str, render: Callable[[str], str]) -> None:
+        self.sources[key] = (url, render)
+        self._locks[key] = Lock()
+
+    def get(self, key: str) -> str:
+        with self._locks[key]:
+            entry = self._entries.get(key)
+            if entry and time.time() < entry["expires"]:
+                return entry["text"]
+            url, render = self.sources[key]
+            headers = {}
+            if entry and entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry and entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+            try:
+                with session.get(url, headers=headers) as resp:
+                    if entry and resp.status_code == 304:
+                        text = entry["text"]
+                    else:
+                        resp.raise_for_status()
+                        text = render(resp.text)
+                    etag = resp.headers.get("ETag")
+                    last_modified = resp.headers.get("Last-Modified")
+            except Exception as ex:
+                if not entry:
+                    raise
+                self.logger.warning("Serving stale %s: %r", key, ex)
+                # upstream is down or changed, don't retry every request
+                entry["expires"] = time.time() + DRAW_RETRY
+                return entry["text"]
+            changed = entry is not None and text != entry["text"]
+            self._entries[key] = dict(
+                text=text,
+                etag=etag,
+                last_modified=last_modified,
+                expires=_draw_cache_expiration(changed),
+            )
+            return text
+
+    def run(self, logger) -> None:
+        self.logger = logger
+        retry: Dict[str, float] = {}
+        while True:
+            deadline = min(
+                [entry["expires"] for entry in self._entries.values()]
+                + list(retry.values()),
+                default=_draw_cache_expiration(True),
+            )
+            time.sleep(max(deadline - time.time(), 1))
+            for key in self.sources:
+                if retry.get(key, 0) > time.time():
+                    continue
+                try:
+                    self.get(key)
+                    retry.pop(key, None)
+                except Exception as ex:
+                    logger.exception(ex)
+                    # nothing cached yet, don't retry every second
+                    retry[key] = time.time() + DRAW_RETRY
+
+
+class WeatherCache:
+    """Short lived cache of wttr.in pages.
+
+    Concurrent requests for the same location share a single upstream request,
+    the total size of the cached pages is kept under ``max_size`` characters.
+    """
+
+    def __init__(self, ttl: int, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, location: str) -> str:
+        key = " ".join(location.lower().split())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() < entry[0]:
+                self._entries.move_to_end(key)
+                return entry[1]
+            waiting = self._inflight.get(key)
+            if waiting is None:
+                future: Future = Future()
+                self._inflight[key] = future
+        if waiting is not None:
+            return waiting.result()
+
+        try:
+            with session.get(f"https://wttr.in/{quote(key)}?Fnp&lang=en") as resp:
+                html, cacheable = resp.text, resp.ok
+        except Exception as ex:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(ex)
+            raise
+        with self._lock:
+            if cacheable:
+                self._store(key, html)
+            del self._inflight[key]
+        future.set_result(html)
+        return html
+
+    def _store(self, key: str, html: str) -> None:
+        old = self._entries.pop(key, None)
+        if old:
+            self._size -= len(old[1])
+        if len(html) > self.max_size:
+            return
+        self._entries[key] = (time.time() + self.ttl, html)
+        self._size += len(html)
+        while self._size > self.max_size:
+            self._size -= len(self._entries.popitem(last=False)[1][1])
+
+
+prefetcher = Prefetcher()
+draw_cache = DrawCache()
+weather_cache = WeatherCache(WTTR_TTL, WTTR_CACHE_SIZE)
+
+
+@simplebot.hookimpl
+def deltabot_init(bot) -> None:
+    _getdefault(bot, "prefetch_size", "10")
+    _getdefault(bot, "prefetch_persist", "1")
+
+
+@simplebot.hookimpl
+def deltabot_start(bot) -> None:
+    prefetcher.size = int(_getdefault(bot, "prefetch_size"))
+    prefetcher.register("chiste", _chiste)
+    prefetcher.register("advice", _advice)
+    prefetcher.register("chuckjoke", _chuckjoke)
+    prefetcher.register("joke", _joke)
+    prefetcher.register("dadjoke", _dadjoke)
+    if _getdefault(bot, "prefetch_persist") == "1":
+        prefetcher.load(bot.get("prefetched", scope=__name__) or "{}")
+    Thread(target=prefetcher.run, args=(bot.logger,), daemon=True).start()
+    draw_cache.register(
+        "bolita",
+        "https://flalottery.com/video/en/theWinningNumber.xml",
+        _render_bolita,
+    )
+    draw_cache.register(
+        "adivinanza",
+        "https://bolitacuba.com/probabilidad-y-adivinanza/",
+        functools.partial(_render_adivinanza, bot.logger),
+    )
+    Thread(target=draw_cache.run, args=(bot.logger,), daemon=True).start()
+
+
+@simplebot.hookimpl
+def deltabot_shutdown(bot) -> None:
+    if _getdefault(bot, "prefetch_persist") == "1":
+        bot.set("prefetched", prefetcher.dump(), scope=__name__)
+
+
 @simplebot.hookimpl
 def deltabot_member_added(bot, chat, contact, actor) -> None:
     if (
@@ -44,11 +306,13 @@ def html2file_filter(message, replies) -> None:
 @simplebot.command
 def bolita(replies) -> None:
     """Los resultados de la bolita (lotería de la Florida)"""
+    replies.add(text=draw_cache.get("bolita"))
+
+
+def _render_bolita(xml: str) -> str:
     import feedparser
 
-    with session.get("https://flalottery.com/video/en/theWinningNumber.xml") as resp:
-        resp.raise_for_status()
-        d = feedparser.parse(resp.text)
+    d = feedparser.parse(xml)
     pick3, pick4 = "", ""
     regex = re.compile(r"([\d-]+) for (\w+) ([\d/]+)")
     for entry in d.entries:
@@ -62,16 +326,21 @@ def bolita(replies) -> None:
             else:
                 pick4 = text
     assert pick3 and pick4
-    replies.add(text=f"**🎰 Resultados**\n\n**PICK 3**\n{pick3}\n**PICK 4**\n{pick4}")
+    return f"**🎰 Resultados**\n\n**PICK 3**\n{pick3}\n**PICK 4**\n{pick4}"
 
 
 @simplebot.command
-def adivinanza(bot, replies) -> None:
+def adivinanza(replies) -> None:
     """Probabilidad y adivinanza para la bolita (lotería de la Florida)"""
-    with session.get("https://bolitacuba.com/probabilidad-y-adivinanza/") as resp:
-        resp.raise_for_status()
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    url = soup.find(class_="alm-reveal").a["href"]
+    replies.add(text=draw_cache.get("adivinanza"))
+
+
+def _render_adivinanza(logger, html: str) -> str:
+    url = _parse(
+        html,
+        lambda soup: soup.find(class_="alm-reveal").a["href"],
+        bs4.SoupStrainer(class_="alm-reveal"),
+    )
     base_url, resource = url.rstrip("/").rsplit("/", maxsplit=1)
     resource = (
         datetime.strptime(resource.split("pya-")[-1], "%m-%d-%Y") + timedelta(days=1)
@@ -79,68 +348,130 @@ def adivinanza(bot, replies) -> None:
     try:
         with session.get(f"{base_url}/{resource}/") as resp:
             resp.raise_for_status()
-            soup = bs4.BeautifulSoup(resp.text, "html5lib")
+            html = resp.text
     except requests.HTTPError as err:
-        bot.logger.exception(err)
+        logger.exception(err)
         with session.get(url) as resp:
             resp.raise_for_status()
-            soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    soup = soup.find(class_="entry-content")
-    for tag in soup(class_="code-block"):
-        tag.extract()
-    for tag in soup("i", class_="fa-sun"):
-        tag.replace_with("☀️")
-    for tag in soup("i", class_="fa-moon"):
-        tag.replace_with("🌙")
-    replies.add(text=_soup2text(soup))
+            html = resp.text
+
+    def extract(soup: bs4.BeautifulSoup) -> str:
+        soup = soup.find(class_="entry-content")
+        for tag in soup(class_="code-block"):
+            tag.extract()
+        for tag in soup("i", class_="fa-sun"):
+            tag.replace_with("☀️")
+        for tag in soup("i", class_="fa-moon"):
+            tag.replace_with("🌙")
+        return _soup2text(soup)
+
+    return _parse(html, extract, bs4.SoupStrainer(class_="entry-content"))
+
+
+def _draw_cache_expiration(changed: bool) -> float:
+    """Get when a reply fetched now, changed or not, must be revalidated."""
+    now = datetime.now(DRAW_TZ)
+    draws = []
+    for days in (-1, 0, 1):
+        day = now.date() + timedelta(days=days)
+        for hour, minute in DRAW_TIMES:
+            draws.append(
+                datetime(day.year, day.month, day.day, hour, minute, tzinfo=DRAW_TZ)
+            )
+    last_draw = max(draw for draw in draws if draw <= now)
+    next_draw = min(draw for draw in draws if draw > now)
+    since_draw = (now - last_draw).total_seconds()
+    if since_draw < DRAW_WINDOW and not changed:
+        return time.time() + DRAW_RETRY
+    return next_draw.timestamp() + DRAW_GRACE
 
 
 @simplebot.command
 def chiste(replies) -> None:
     """Envía un chiste al azar."""
+    replies.add(text=prefetcher.pop("chiste") or _chiste())
+
+
+def _chiste() -> str:
     while True:
         text = random.choice(
             (_chistes, _chistalia, _todo_chistes, _elclubdeloschistes)
         )()
         if text:
-            break
-    replies.add(text=text)
+            return text
 
 
 def _chistes() -> str:
     with session.get("http://www.chistes.com/ChisteAlAzar.asp?n=2") as resp:
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    return _soup2text(soup.find(class_="chiste")) + "\n\nFuente: http://www.chistes.com"
+        text = _parse(
+            resp.text,
+            lambda soup: _soup2text(soup.find(class_="chiste")),
+            bs4.SoupStrainer(class_="chiste"),
+        )
+    return text + "\n\nFuente: http://www.chistes.com"
 
 
 def _chistalia() -> str:
     with session.get("https://chistalia.es/aleatorio/") as resp:
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    return _soup2text(soup.blockquote) + "\n\nFuente: https://chistalia.es"
+        text = _parse(
+            resp.text,
+            lambda soup: _soup2text(soup.blockquote),
+            bs4.SoupStrainer("blockquote"),
+        )
+    return text + "\n\nFuente: https://chistalia.es"
 
 
 def _todo_chistes() -> str:
     with session.get("http://todo-chistes.com/chistes-al-azar") as resp:
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    return (
-        _soup2text(soup.find(class_="field-chiste"))
-        + "\n\nFuente: http://todo-chistes.com"
-    )
+        text = _parse(
+            resp.text,
+            lambda soup: _soup2text(soup.find(class_="field-chiste")),
+            bs4.SoupStrainer(class_="field-chiste"),
+        )
+    return text + "\n\nFuente: http://todo-chistes.com"
 
 
 def _elclubdeloschistes() -> str:
+    def extract(soup: bs4.BeautifulSoup) -> str:
+        soup.b.extract()
+        for tag in soup("a"):
+            tag.extract()
+        text = _soup2text(soup.find(class_="texto"))
+        return text[: text.rfind("ID:")].strip()
+
     with session.get("https://elclubdeloschistes.com/azar.php") as resp:
-        soup = bs4.BeautifulSoup(resp.text, "html5lib")
-    soup.b.extract()
-    for tag in soup("a"):
-        tag.extract()
-    text = _soup2text(soup.find(class_="texto"))
-    text = text[: text.rfind("ID:")].strip()
+        # no strainer, the first <b> tag of the whole document must be removed
+        text = _parse(resp.text, extract)
     if not text:
         return ""
     return text + "\n\nFuente: https://elclubdeloschistes.com"
 
 
+def _parse(
+    html: str, extract: Callable, parse_only: Optional[bs4.SoupStrainer] = None
+) -> Any:
+    """Extract data from the given HTML using the fastest parser available.
+
+    The document is parsed with lxml, limited to the tags matching parse_only,
+    and only if that finds nothing it is parsed again with html5lib.
+    """
+    try:
+        result = extract(bs4.BeautifulSoup(html, "lxml", parse_only=parse_only))
+        if result:
+            return result
+    except Exception:  # lxml missing or it didn't parse the page as expected
+        pass
+    return extract(bs4.BeautifulSoup(html, "html5lib"))
+
+
+def _getdefault(bot, key: str, value: str = None) -> str:
+    val = bot.get(key, scope=__name__)
+    if val is None and value is not None:
+        bot.set(key, value, scope=__name__)
+        val = value
+    return val
+
+
 def _soup2text(soup: bs4.BeautifulSoup) -> str:
     for tag in soup("br"):
         tag.replace_with("\n")
@@ -164,35 +495,54 @@ def insult(payload, message, replies) -> None:
 @simplebot.command
 def advice(replies) -> None:
     """get random advice."""
+    replies.add(text=prefetcher.pop("advice") or _advice())
+
+
+def _advice() -> str:
     with session.get("https://api.adviceslip.com/advice") as resp:
-        replies.add(text=resp.json()["slip"]["advice"])
+        return resp.json()["slip"]["advice"]
 
 
 @simplebot.command
 def chuckjoke(replies) -> None:
     """get random Chuck Norris joke."""
+    replies.add(text=prefetcher.pop("chuckjoke") or _chuckjoke())
+
+
+def _chuckjoke() -> str:
     with session.get("http://api.icndb.com/jokes/random?escape=javascript") as resp:
-        replies.add(text=resp.json()["value"]["joke"])
+        return resp.json()["value"]["joke"]
 
 
 @simplebot.command
 def joke(payload, replies) -> None:
     """get random joke."""
+    text = None if payload else prefetcher.pop("joke")
+    replies.add(text=text or _joke(payload))
+
+
+def _joke(contains: str = "") -> str:
     with session.get(
-        f"https://v2.jokeapi.dev/joke/Any?format=txt&contains={payload}"
+        f"https://v2.jokeapi.dev/joke/Any?format=txt&contains={contains}"
     ) as resp:
-        replies.add(text=resp.text)
+        resp.raise_for_status()
+        return resp.text
 
 
 @simplebot.command
 def dadjoke(replies) -> None:
     """get random dad joke."""
+    replies.add(text=prefetcher.pop("dadjoke") or _dadjoke())
+
+
+def _dadjoke() -> str:
     headers = {
         "User-Agent": "SimpleBot (https://github.com/simplebot-org/simplebot)",
         "Accept": "text/plain",
     }
     with session.get("https://icanhazdadjoke.com/", headers=headers) as resp:
-        replies.add(text=resp.text)
+        resp.raise_for_status()
+        return resp.text
 
 
 @simplebot.command
@@ -230,5 +580,5 @@ def file2html(payload, message, replies) -> None:
 @simplebot.command
 def wttr(payload, message, replies) -> None:
     """Search weather info from wttr.in"""
-    with session.get(f"https://wttr.in/{quote(payload)}?Fnp&lang=en") as resp:
-        replies.add(text="Result from wttr.in", html=resp.text, quote=message)
+    html = weather_cache.get(payload)
+    replies.add(text="Result from wttr.in", html=html, quote=message)
@@ -0,0 +1,264 @@
+"""Shared scheduler for the background jobs of other scripts.
+
+All jobs run on a single timer heap and a small pool of worker threads.
+Other scripts placed in the same folder can use it as a module:
+
+  import scheduler
+
+  scheduler.every(60 * 60, check_something, bot)
+  scheduler.cron("0 9 * * 1", weekly_report, bot)
+  scheduler.at(time.time() + 30, do_something_later, bot)
+"""
+
+import heapq
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Condition, Thread
+from typing import Callable, List, Optional, Set, Tuple
+
+import simplebot
+from simplebot.bot import DeltaBot, Replies
+
+WORKERS = 4
+
+
+class CronSpec:
+    """Cron-like "minute hour day month weekday" schedule, in local time.
+
+    Fields support "*", lists, ranges and steps like "*/15" or "1-5".
+    Weekdays go from 0 (Sunday) to 6.
+    """
+
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+    month_days = (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+    def __init__(self, expr: str) -> None:
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid cron expression: {expr!r}")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(field, *bounds) for field, bounds in zip(fields, self.ranges)
+        )
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+        # without weekdays the day must exist in one of the months, like 31/2
+        if self._any_weekday and not any(
+            day <= self.month_days[month - 1]
+            for day in self.days
+            for month in self.months
+        ):
+            raise ValueError(f"Cron expression never matches: {expr!r}")
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> Set[int]:
+        values: Set[int] = set()
+        for part in field.split(","):
+            rng, _, step = part.partition("/")
+            if rng == "*":
+                start, end = low, high
+            elif "-" in rng:
+                start, end = map(int, rng.split("-"))
+            else:
+                start = end = int(rng)
+                if step:
+                    end = high
+            if start < low or end > high:
+                raise ValueError(f"Invalid cron field: {field!r}")
+            values.update(range(start, end + 1, int(step or 1)))
+        return values
+
+    def _match_day(self, date: datetime) -> bool:
+        day = date.day in self.days
+        weekday = (date.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_run(self, after: float) -> float:
+        date = datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+        date += timedelta(minutes=1)
+        while True:
+            if date.month not in self.months:
+                date = (date.replace(day=1) + timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0
+                )
+            elif not self._match_day(date):
+                date = date.replace(hour=0, minute=0) + timedelta(days=1)
+            elif date.hour not in self.hours:
+                date = date.replace(minute=0) + timedelta(hours=1)
+            elif date.minute not in self.minutes:
+                date += timedelta(minutes=1)
+            else:
+                return date.timestamp()
+
+
+class Job:
+    """A scheduled job and its run-time statistics."""
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        args: tuple,
+        next_run: float,
+        interval: Optional[float] = None,
+        cron: Optional[CronSpec] = None,
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.args = args
+        self.next_run = next_run
+        self.interval = interval
+        self.cron = cron
+        self.cancelled = False
+        self.runs = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def periodic(self) -> bool:
+        return self.interval is not None or self.cron is not None
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def __str__(self) -> str:
+        avg = self.total_time / self.runs if self.runs else 0
+        text = (
+            f"{self.name}: {self.runs} runs, {self.failures} failures,"
+            f" {avg:.2f}s avg, {self.max_time:.2f}s max"
+        )
+        if not self.cancelled and self.next_run:
+            text += f", next in {max(self.next_run - time.time(), 0):.0f}s"
+        return text
+
+
+class Scheduler:
+    """Run jobs at fixed intervals, cron-like schedules or given timestamps."""
+
+    def __init__(self, workers: int = WORKERS) -> None:
+        self.jobs: List[Job] = []
+        self._heap: List[Tuple[float, int, Job]] = []
+        self._counter = itertools.count()
+        self._cond = Condition()
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="scheduler"
+        )
+        self._thread: Optional[Thread] = None
+        self._stopped = False
+        self.logger = logging.getLogger(__name__)
+
+    def every(
+        self,
+        interval: float,
+        func: Callable,
+        *args,
+        name: str = None,
+        delay: float = None,
+    ) -> Job:
+        """Run func every interval seconds, the first run is after delay seconds.
+
+        If delay is not given the first run is after interval seconds.
+        """
+        next_run = time.time() + (interval if delay is None else delay)
+        return self._add(Job(name or func.__name__, func, args, next_run, interval))
+
+    def cron(self, expr: str, func: Callable, *args, name: str = None) -> Job:
+        """Run func on the given cron-like schedule."""
+        spec = CronSpec(expr)
+        next_run = spec.next_run(time.time())
+        return self._add(Job(name or func.__name__, func, args, next_run, cron=spec))
+
+    def at(self, timestamp: float, func: Callable, *args, name: str = None) -> Job:
+        """Run func once at the given timestamp."""
+        return self._add(Job(name or func.__name__, func, args, timestamp))
+
+    def shutdown(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._pool.shutdown(wait=False)
+
+    def _add(self, job: Job) -> Job:
+        with self._cond:
+            if job.periodic:
+                self.jobs.append(job)
+            self._push(job)
+            if self._thread is None:
+                self._thread = Thread(target=self._loop, daemon=True)
+                self._thread.start()
+        return job
+
+    def _push(self, job: Job) -> None:
+        heapq.heappush(self._heap, (job.next_run, next(self._counter), job))
+        if self._heap[0][2] is job:
+            self._cond.notify()
+
+    def _loop(self) -> None:
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                next_run, _, job = self._heap[0]
+                now = time.time()
+                if next_run > now:
+                    self._cond.wait(next_run - now)
+                    continue
+                heapq.heappop(self._heap)
+                if not job.cancelled:
+                    self._pool.submit(self._run, job)
+                elif job in self.jobs:
+                    self.jobs.remove(job)
+
+    def _run(self, job: Job) -> None:
+        start = time.time()
+        try:
+            job.func(*job.args)
+        except Exception as err:
+            job.failures += 1
+            self.logger.exception(err)
+        took = time.time() - start
+        job.runs += 1
+        job.total_time += took
+        job.max_time = max(job.max_time, took)
+        if job.periodic and not job.cancelled:
+            if job.cron:
+                job.next_run = job.cron.next_run(time.time())
+            elif job.interval is not None:
+                job.next_run = max(start + job.interval, time.time())
+            with self._cond:
+                self._push(job)
+        else:
+            job.next_run = 0
+            job.cancelled = True
+            with self._cond:
+                if job in self.jobs:
+                    self.jobs.remove(job)
+
+
+_scheduler = Scheduler()
+every = _scheduler.every
+cron = _scheduler.cron
+at = _scheduler.at
+
+
+@simplebot.hookimpl(tryfirst=True)
+def deltabot_start(bot: DeltaBot) -> None:
+    _scheduler.logger = bot.logger
+
+
+@simplebot.hookimpl
+def deltabot_shutdown() -> None:
+    _scheduler.shutdown()
+
+
+@simplebot.command(name="/scheduler", admin=True)
+def scheduler_cmd(replies: Replies) -> None:
+    """Get the list of periodic background jobs and their run-time statistics."""
+    text = "\n\n".join(str(job) for job in list(_scheduler.jobs))
+    replies.add(text=text or "❌ No jobs")
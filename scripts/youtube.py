@@ -3,11 +3,19 @@ requirements:
 simplebot_downloader
 yt-dlp or youtube-dl
 """
+import functools
+import hashlib
+import json
+import math
 import os
+import re
+import shutil
+import sqlite3
 import time
-from collections import OrderedDict
-from threading import Thread
-from typing import Callable, Dict, Generator
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from typing import Callable, Deque, Dict, Generator, List, Optional, Tuple
 
 import simplebot
 
@@ -20,15 +28,320 @@ except ModuleNotFoundError:
 
 from deltachat import Message
 from simplebot.bot import DeltaBot, Replies
-from simplebot_downloader.util import FileTooBig, get_setting, split_download  # noqa
+from simplebot_downloader.util import (  # noqa
+    FileTooBig,
+    get_setting,
+    sizeof_fmt,
+    split_download,
+)
 
 MAX_QUEUE_SIZE = 20
-downloads: Dict[str, Generator] = OrderedDict()
+VIDEO_ID_REGEX = re.compile(
+    r"^(?:https?://)?(?:(?:www|m|music)\.)?(?:youtu\.be/|youtube\.com/"
+    r"(?:watch\?(?:\S*&)?v=|shorts/|embed/|live/))([\w-]{11})(?![\w-])"
+)
+METADATA_TTL = 60 * 10
+METADATA_CACHE_SIZE = 100
+MIN_QUALITY = {"video": ("height", 360), "audio": ("abr", 64)}
+FORMAT_KEYS = (
+    "format_id",
+    "vcodec",
+    "acodec",
+    "height",
+    "abr",
+    "tbr",
+    "filesize",
+    "filesize_approx",
+)
+
+
+class DownloadCache:
+    """Downloaded files, already split in parts, kept in disk.
+
+    Entries are evicted in least recently used order when the cache is over
+    max_size bytes, entries being sent (pinned) are never evicted.
+    Concurrent requests of the same missing entry are served by one download.
+    Nothing is evicted until evict() is called, so the entries needed by
+    the resumed downloads can be pinned with hold() first.
+    """
+
+    def __init__(self, folder: str, max_size: int) -> None:
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._pins: Dict[str, int] = {}
+        self._inflight: Dict[str, Future] = {}
+        self._lock = Lock()
+        os.makedirs(folder, exist_ok=True)
+        found = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            manifest = os.path.join(path, "parts.json")
+            if os.path.exists(manifest):
+                found.append((os.stat(manifest).st_mtime, name))
+            else:  # unfinished download
+                shutil.rmtree(path, ignore_errors=True)
+        for _, key in sorted(found):
+            with open(
+                os.path.join(folder, key, "parts.json"), encoding="utf-8"
+            ) as file:
+                self._add(key, json.load(file))
+
+    @property
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def acquire(self, key: str, fill: Callable[[str], List[str]]) -> List[str]:
+        """Get the paths of the parts of the given entry and pin it.
+
+        If the entry is not cached, fill is called with the folder where the
+        parts must be saved and must return their filenames in order.
+        release() must be called once the parts are not needed anymore.
+        """
+        waited = False
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    if not waited:
+                        self.hits += 1
+                    return self._pin(key)
+                future = self._inflight.get(key)
+                if future is None:
+                    future = self._inflight[key] = Future()
+                    self.misses += 1
+                    break
+                if not waited:
+                    self.coalesced += 1
+            waited = True
+            future.result()  # the download failed if this raises
+            # retry in case the entry was evicted in the meantime
+        try:
+            parts = self._fill(key, fill)
+        except Exception as ex:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(ex)
+            raise
+        with self._lock:
+            del self._inflight[key]
+            self._add(key, parts)
+            paths = self._pin(key)
+        future.set_result(None)
+        self.evict()
+        return paths
+
+    def hold(self, key: str) -> bool:
+        """Pin the given entry if it is cached, without counting a hit.
+
+        Returns whether the entry was pinned, release() must be called then.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._pin(key)
+            return True
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._pins[key] -= 1
+            if not self._pins[key]:
+                del self._pins[key]
+        self.evict()
+
+    def _fill(self, key: str, fill: Callable[[str], List[str]]) -> List[str]:
+        folder = os.path.join(self.folder, key)
+        tempdir = folder + ".tmp"
+        shutil.rmtree(tempdir, ignore_errors=True)
+        os.makedirs(tempdir)
+        try:
+            parts = fill(tempdir)
+            with open(
+                os.path.join(tempdir, "parts.json"), "w", encoding="utf-8"
+            ) as file:
+                json.dump(parts, file)
+            os.rename(tempdir, folder)
+        except Exception:
+            shutil.rmtree(tempdir, ignore_errors=True)
+            raise
+        return parts
+
+    def _add(self, key: str, parts: List[str]) -> None:
+        folder = os.path.join(self.folder, key)
+        self._entries[key] = [os.path.join(folder, name) for name in parts]
+        self._sizes[key] = sum(os.stat(path).st_size for path in self._entries[key])
+
+    def _pin(self, key: str) -> List[str]:
+        self._entries.move_to_end(key)
+        self._pins[key] = self._pins.get(key, 0) + 1
+        # keep the LRU order across restarts
+        os.utime(os.path.join(self.folder, key, "parts.json"))
+        return self._entries[key]
+
+    def evict(self) -> None:
+        with self._lock:
+            size = self.size
+            for key in list(self._entries):
+                if size <= self.max_size:
+                    break
+                if key in self._pins:
+                    continue
+                size -= self._sizes.pop(key)
+                del self._entries[key]
+                shutil.rmtree(os.path.join(self.folder, key), ignore_errors=True)
+
+
+class Download:
+    """A download request and its progress."""
+
+    def __init__(
+        self,
+        addr: str,
+        url: str,
+        kind: str,
+        part_size: int,
+        max_size: int,
+        sent: int = 0,
+        parts_count: int = 0,
+        queued: float = None,
+        format_id: str = None,
+        size: int = None,
+    ) -> None:
+        self.addr = addr
+        self.url = url
+        self.kind = kind
+        self.part_size = part_size
+        self.max_size = max_size
+        self.sent = sent
+        self.parts_count = parts_count
+        self.queued = queued or time.time()
+        self.format_id = format_id
+        self.size = size  # estimated before downloading
+        self.active = False
+        self.cache_key = _cache_key(url, kind, part_size, max_size, format_id)
+        self.parts = self._parts()
+
+    def hold(self) -> None:
+        """Keep the cached parts of a resumed download until it is sent."""
+        assert cache is not None
+        if cache.hold(self.cache_key):
+            self.parts = self._parts(held=True)
+
+    def _parts(self, held: bool = False) -> Generator:
+        return _cached_download(
+            self.url,
+            self.kind,
+            self.part_size,
+            self.max_size,
+            self.sent + 1,
+            self.format_id,
+            held,
+        )
+
+    def row(self) -> tuple:
+        return (
+            self.addr,
+            self.url,
+            self.kind,
+            self.part_size,
+            self.max_size,
+            self.sent,
+            self.parts_count,
+            self.queued,
+            self.format_id,
+            self.size,
+        )
+
+
+class QueueStore:
+    """Persistent copy of the download queue so it survives restarts."""
+
+    def __init__(self, path: str) -> None:
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS queue (
+                addr TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                part_size INTEGER NOT NULL,
+                max_size INTEGER NOT NULL,
+                sent INTEGER NOT NULL,
+                parts_count INTEGER NOT NULL,
+                queued REAL NOT NULL,
+                format_id TEXT,
+                size INTEGER)"""
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(queue)")]
+            for column in ("format_id TEXT", "size INTEGER"):
+                if column.split()[0] not in columns:
+                    self._db.execute(f"ALTER TABLE queue ADD COLUMN {column}")
+
+    def load(self) -> List[Tuple]:
+        with self._lock:
+            return self._db.execute("SELECT * FROM queue ORDER BY queued").fetchall()
+
+    def add(self, download: Download) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "REPLACE INTO queue VALUES (?,?,?,?,?,?,?,?,?,?)", download.row()
+            )
+
+    def update(self, download: Download) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE queue SET sent=?, parts_count=? WHERE addr=?",
+                (download.sent, download.parts_count, download.addr),
+            )
+
+    def remove(self, addr: str) -> None:
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM queue WHERE addr=?", (addr,))
+
+
+downloads: Dict[str, Download] = OrderedDict()
+ready: Deque[str] = deque()  # users waiting for their next part, in turn order
+queue_cond = Condition()
+rate: dict = {"workers": 1, "next_send": 0.0, "speed": 1024**2}
+metadata: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+metadata_lock = Lock()
+cache: Optional[DownloadCache] = None
+store: Optional[QueueStore] = None
+
+
+@simplebot.hookimpl
+def deltabot_init(bot: DeltaBot) -> None:
+    _getdefault(bot, "workers", "2")
+    _getdefault(bot, "cache_size", str(1024**3 * 2))
 
 
 @simplebot.hookimpl
 def deltabot_start(bot: DeltaBot) -> None:
-    Thread(target=_send_files, args=(bot,)).start()
+    global cache, store
+    folder = os.path.dirname(bot.account.db_path)
+    cache = DownloadCache(
+        os.path.join(folder, "youtube_cache"), int(_getdefault(bot, "cache_size"))
+    )
+    store = QueueStore(os.path.join(folder, "youtube.db"))
+    with queue_cond:
+        for row in store.load():
+            # resume from the next part that was not sent
+            download = downloads[row[0]] = Download(*row)
+            download.hold()
+            ready.append(row[0])
+    # only after the parts of the resumed downloads are pinned
+    cache.evict()
+    bot.logger.debug("Resuming YouTube downloads queue (%s)", len(downloads))
+    rate["workers"] = max(int(_getdefault(bot, "workers")), 1)
+    for num in range(rate["workers"]):
+        Thread(target=_worker, args=(bot,), name=f"youtube-{num}", daemon=True).start()
 
 
 @simplebot.command
@@ -38,7 +351,7 @@ def yt2video(bot: DeltaBot, payload: str, message: Message, replies: Replies) ->
     Example:
     /yt2video https://www.youtube.com/watch?v=tZpxR8iM19s
     """
-    queue_download(payload, bot, message, replies, download_ytvideo)
+    queue_download(payload, bot, message, replies, "video")
 
 
 @simplebot.command
@@ -48,13 +361,16 @@ def yt2audio(bot: DeltaBot, payload: str, message: Message, replies: Replies) ->
     Example:
     /yt2audio https://www.youtube.com/watch?v=tZpxR8iM19s
     """
-    queue_download(payload, bot, message, replies, download_ytaudio)
+    queue_download(payload, bot, message, replies, "audio")
 
 
-def download_ytvideo(url: str, folder: str, max_size: int) -> str:
+def download_ytvideo(
+    url: str, folder: str, max_size: int, format_id: str = None
+) -> str:
     opts = {
-        "format": f"best[filesize<?{max_size}]",
+        "format": format_id or f"best[filesize<?{max_size}]",
         "max_downloads": 1,
+        "max_filesize": max_size,
         "socket_timeout": 15,
         "outtmpl": os.path.join(folder, "%(id)s.%(ext)s"),
     }
@@ -63,13 +379,16 @@ def download_ytvideo(url: str, folder: str, max_size: int) -> str:
             yt.download([url])
     except MaxDownloadsReached:
         pass
-    return os.path.join(folder, os.listdir(folder)[0])
+    return _downloaded_file(folder, max_size)
 
 
-def download_ytaudio(url: str, folder: str, max_size: int) -> str:
+def download_ytaudio(
+    url: str, folder: str, max_size: int, format_id: str = None
+) -> str:
     opts = {
-        "format": f"bestaudio[filesize<?{max_size}]",
+        "format": format_id or f"bestaudio[filesize<?{max_size}]",
         "max_downloads": 1,
+        "max_filesize": max_size,
         "socket_timeout": 15,
         "outtmpl": os.path.join(folder, "%(id)s.%(ext)s"),
     }
@@ -78,7 +397,46 @@ def download_ytaudio(url: str, folder: str, max_size: int) -> str:
             yt.download([url])
     except MaxDownloadsReached:
         pass
-    return os.path.join(folder, os.listdir(folder)[0])
+    return _downloaded_file(folder, max_size)
+
+
+def _downloaded_file(folder: str, max_size: int) -> str:
+    files = [
+        name for name in os.listdir(folder) if not name.endswith((".part", ".ytdl"))
+    ]
+    if not files:  # yt-dlp skips or aborts files over max_filesize
+        raise FileTooBig(f"Only files smaller than {sizeof_fmt(max_size)} are allowed")
+    return os.path.join(folder, files[0])
+
+
+@simplebot.command
+def ytqueue(message: Message, replies: Replies) -> None:
+    """Show the state of the YouTube downloads queue and of your download."""
+    addr = message.get_sender_contact().addr
+    with queue_cond:
+        items = list(downloads.values())
+    text = (
+        f"Downloads in queue: {len(items)}/{MAX_QUEUE_SIZE}\nWorkers: {rate['workers']}"
+    )
+    if cache is not None:
+        text += (
+            f"\nCached files: {len(cache)} ({cache.size // 1024**2}MiB),"
+            f" {cache.hits} hits, {cache.misses} misses"
+        )
+    for pos, download in enumerate(items, 1):
+        if download.addr == addr:
+            if download.parts_count:
+                state = f"{download.sent}/{download.parts_count} parts sent"
+            elif download.active:
+                state = "downloading"
+            else:
+                state = "waiting"
+            text += f"\n\nYour download (position {pos}): {state}\n{download.url}"
+            break
+    replies.add(text=text, quote=message)
+
+
+DOWNLOADERS = {"video": download_ytvideo, "audio": download_ytaudio}
 
 
 def queue_download(
@@ -86,50 +444,281 @@ def queue_download(
     bot: DeltaBot,
     message: Message,
     replies: Replies,
-    downloader: Callable,
+    kind: str,
 ) -> None:
     addr = message.get_sender_contact().addr
-    if addr in downloads:
-        replies.add(text="❌ You already have a download in queue", quote=message)
-    elif len(downloads) >= MAX_QUEUE_SIZE:
+    error = _check_queue(addr)
+    if error:
+        replies.add(text=error, quote=message)
+        return
+    part_size = int(get_setting(bot, "part_size"))
+    max_size = int(get_setting(bot, "max_size"))
+    try:
+        info = _get_info(url)
+    except Exception as ex:
+        bot.logger.exception(ex)
         replies.add(
-            text="❌ I'm too busy with too many downloads, try again later",
-            quote=message,
+            text="❌ Failed to get video info, is the link correct?", quote=message
+        )
+        return
+    fmt, error = _choose_format(info, kind, max_size)
+    if error:
+        replies.add(text=f"❌ {error}", quote=message)
+        return
+
+    delay = int(get_setting(bot, "delay"))
+    with queue_cond:
+        error = _check_queue(addr)
+        if error:
+            replies.add(text=error, quote=message)
+            return
+        ahead = len(downloads)
+        download = Download(
+            addr,
+            url,
+            kind,
+            part_size,
+            max_size,
+            format_id=fmt.get("format_id"),
+            size=fmt.get("size"),
         )
+        assert store is not None
+        store.add(download)
+        downloads[addr] = download
+        ready.append(addr)
+        queue_cond.notify()
+
+    eta = _eta(ahead, delay, download.size)
+    text = f"✔️ Request added to queue (position {ahead + 1})"
+    if download.size:
+        parts = math.ceil(download.size / part_size)
+        text += f"\n\n{info.get('title') or url}\n~{sizeof_fmt(download.size)} in {parts} parts"
+        text += f"\nFirst part in ~{eta // 60 + 1} minutes"
+        if parts > 1:
+            # every user gets a turn before the next part is sent
+            total = int(eta + (parts - 1) * (ahead + 1) * delay)
+            text += f", all parts in ~{total // 60 + 1} minutes"
     else:
-        replies.add(text="✔️ Request added to queue", quote=message)
-        part_size = int(get_setting(bot, "part_size"))
-        max_size = int(get_setting(bot, "max_size"))
-        downloads[addr] = split_download(url, part_size, max_size, downloader)
+        text += f", first part in ~{eta // 60 + 1} minutes"
+    replies.add(text=text, quote=message)
 
 
-def _send_files(bot: DeltaBot) -> None:
-    replies = Replies(bot, bot.logger)
+def _check_queue(addr: str) -> str:
+    if addr in downloads:
+        return "❌ You already have a download in queue"
+    if len(downloads) >= MAX_QUEUE_SIZE:
+        return "❌ I'm too busy with too many downloads, try again later"
+    return ""
+
+
+def _get_info(url: str) -> dict:
+    """Get the metadata of the given URL without downloading it."""
+    now = time.time()
+    with metadata_lock:
+        expires, info = metadata.get(url, (0, {}))
+        if expires > now:
+            metadata.move_to_end(url)
+            return info
+    opts = {"socket_timeout": 15, "noplaylist": True, "extract_flat": "in_playlist"}
+    with YoutubeDL(opts) as yt:
+        info = yt.extract_info(url, download=False)
+    info = {
+        "title": info.get("title"),
+        "duration": info.get("duration"),
+        "playlist": info.get("_type") in ("playlist", "multi_video")
+        or "entries" in info,
+        "live": bool(info.get("is_live"))
+        or info.get("live_status") in ("is_live", "is_upcoming"),
+        "formats": [
+            {key: fmt.get(key) for key in FORMAT_KEYS}
+            for fmt in info.get("formats") or [info]
+        ],
+    }
+    with metadata_lock:
+        metadata[url] = (now + METADATA_TTL, info)
+        metadata.move_to_end(url)
+        while len(metadata) > METADATA_CACHE_SIZE:
+            metadata.popitem(last=False)
+    return info
+
+
+def _choose_format(info: dict, kind: str, max_size: int) -> Tuple[dict, str]:
+    """Choose the smallest format of the given kind with acceptable quality.
+
+    Returns the format with its estimated size, or the reason why the media
+    can't be downloaded.
+    """
+    if info["playlist"]:
+        return {}, "Playlists are not supported"
+    if info["live"]:
+        return {}, "Live streams are not supported"
+    candidates = []
+    for fmt in info["formats"]:
+        has_video = fmt["vcodec"] != "none"
+        if fmt["acodec"] == "none" or has_video != (kind == "video"):
+            continue
+        size = fmt["filesize"] or fmt["filesize_approx"]
+        if not size and fmt["tbr"] and info["duration"]:
+            size = fmt["tbr"] * 1000 / 8 * info["duration"]
+        candidates.append(
+            dict(format_id=fmt["format_id"], size=size and int(size), fmt=fmt)
+        )
+    if not candidates:
+        return {}, "No suitable format found"
+    sized = [fmt for fmt in candidates if fmt["size"]]
+    if not sized:  # the size is unknown, let the downloader choose
+        return {}, ""
+    fitting = [fmt for fmt in sized if fmt["size"] <= max_size]
+    if not fitting:
+        return {}, f"Only files smaller than {sizeof_fmt(max_size)} are allowed"
+    key, minimum = MIN_QUALITY[kind]
+    good = [fmt for fmt in fitting if (fmt["fmt"][key] or 0) >= minimum]
+    return min(good or fitting, key=lambda fmt: fmt["size"]), ""
+
+
+def _cached_download(
+    url: str,
+    kind: str,
+    part_size: int,
+    max_size: int,
+    start: int = 1,
+    format_id: str = None,
+    held: bool = False,
+) -> Generator:
+    """Like split_download() but the parts are taken from the cache if possible.
+
+    The parts before the start part are skipped. If held is True the entry
+    was already pinned with DownloadCache.hold() and that pin is released.
+    """
+    key = _cache_key(url, kind, part_size, max_size, format_id)
+    downloader = functools.partial(DOWNLOADERS[kind], format_id=format_id)
+    fill = functools.partial(_fill_cache, url, part_size, max_size, downloader)
+    assert cache is not None
+    try:
+        paths = cache.acquire(key, fill)
+    finally:
+        if held:
+            cache.release(key)
+    try:
+        for num, path in enumerate(paths, 1):
+            if num >= start:
+                yield path, num, len(paths)
+    finally:
+        cache.release(key)
+
+
+def _cache_key(
+    url: str, kind: str, part_size: int, max_size: int, format_id: str = None
+) -> str:
+    match = VIDEO_ID_REGEX.search(url)
+    video_id = match.group(1) if match else hashlib.sha1(url.encode()).hexdigest()
+    return f"{video_id}-{kind}-{format_id or 'best'}-{max_size}-{part_size}"
+
+
+def _fill_cache(
+    url: str, part_size: int, max_size: int, downloader: Callable, folder: str
+) -> List[str]:
+    parts = []
+    for path, _, _ in split_download(url, part_size, max_size, downloader):
+        name = os.path.basename(path)
+        # split_download() removes the part once the next one is requested
+        try:
+            os.link(path, os.path.join(folder, name))
+        except OSError:
+            shutil.copyfile(path, os.path.join(folder, name))
+        parts.append(name)
+    return parts
+
+
+def _eta(ahead: int, delay: int, size: Optional[int]) -> int:
+    """Estimate the seconds until the first part of a new request is sent.
+
+    Users are served in turns and one part is sent every delay seconds, so a
+    new request is downloaded when a worker is free and sent after the turns
+    of the requests ahead of it.
+    """
+    turns = max(ahead - rate["workers"] + 1, 0)
+    download_time = size / rate["speed"] if size else 60
+    return int(max(turns * delay + download_time, ahead * delay))
+
+
+def _worker(bot: DeltaBot) -> None:
     while True:
-        items = list(downloads.items())
-        items = items and [items[0]]
-        bot.logger.debug("Processing YouTube downloads queue (%s)", len(items))
-        start = time.time()
-        for addr, parts in items:
-            chat = bot.get_chat(addr)
+        with queue_cond:
+            while not ready:
+                queue_cond.wait()
+            download = downloads[ready.popleft()]
+            download.active = True
+        try:
+            _send_next_part(bot, download)
+        except Exception as ex:
+            bot.logger.exception(ex)
+        assert store is not None
+        with queue_cond:
+            download.active = False
             try:
-                path, num, parts_count = next(parts)
-                replies.add(text=f"Part {num}/{parts_count}", filename=path, chat=chat)
-                replies.send_reply_messages()
-                if num == parts_count:
-                    next(parts, None)  # close context
-                    downloads.pop(addr, None)
-            except FileTooBig as ex:
-                downloads.pop(addr, None)
-                replies.add(text=f"❌ {ex}", chat=chat)
-                replies.send_reply_messages()
-            except (StopIteration, Exception) as ex:
+                if download.parts_count and download.sent < download.parts_count:
+                    store.update(download)
+                else:
+                    store.remove(download.addr)
+            except Exception as ex:
                 bot.logger.exception(ex)
-                downloads.pop(addr, None)
-                replies.add(
-                    text="❌ Failed to download file, is the link correct?", chat=chat
-                )
-                replies.send_reply_messages()
-        delay = int(get_setting(bot, "delay")) - time.time() + start
-        if delay > 0:
-            time.sleep(delay)
+            if download.parts_count and download.sent < download.parts_count:
+                ready.append(download.addr)
+                queue_cond.notify()
+            else:
+                downloads.pop(download.addr, None)
+
+
+def _wait_send_slot(delay: int) -> None:
+    """Wait for the next time a part can be sent.
+
+    All the workers together send at most one part every delay seconds, the
+    extra workers only download the next parts in the meantime.
+    """
+    with queue_cond:
+        now = time.time()
+        slot = max(now, rate["next_send"])
+        rate["next_send"] = slot + delay
+    time.sleep(max(slot - now, 0))
+
+
+def _send_next_part(bot: DeltaBot, download: Download) -> None:
+    """Send the next part of the given download."""
+    replies = Replies(bot, bot.logger)
+    chat = bot.get_chat(download.addr)
+    try:
+        start = time.time()
+        path, num, parts_count = next(download.parts)
+        took = time.time() - start
+        if num == 1 and download.size and took > 1:  # not a cache hit
+            rate["speed"] = rate["speed"] * 0.8 + download.size / took * 0.2
+        download.parts_count = parts_count
+        _wait_send_slot(int(get_setting(bot, "delay")))
+        replies.add(text=f"Part {num}/{parts_count}", filename=path, chat=chat)
+        replies.send_reply_messages()
+        download.sent = num
+        if num == parts_count:
+            next(download.parts, None)  # close context
+    except FileTooBig as ex:
+        _cancel(download)
+        replies.add(text=f"❌ {ex}", chat=chat)
+        replies.send_reply_messages()
+    except (StopIteration, Exception) as ex:
+        bot.logger.exception(ex)
+        _cancel(download)
+        replies.add(text="❌ Failed to download file, is the link correct?", chat=chat)
+        replies.send_reply_messages()
+
+
+def _cancel(download: Download) -> None:
+    download.parts_count = 0
+    download.parts.close()  # remove the temporary files
+
+
+def _getdefault(bot: DeltaBot, key: str, value: str = None) -> str:
+    val = bot.get(key, scope=__name__)
+    if val is None and value is not None:
+        bot.set(key, value, scope=__name__)
+        val = value
+    return val